@@ -0,0 +1,153 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+import constants
+from framereader import open_capture
+
+# The background models which the detector can use
+MODELS = ('knn', 'median')
+
+
+class RunningMedian:
+    """An approximate running median background model, as a cheaper
+    stand-in for cv2.createBackgroundSubtractorKNN(). It has the same apply
+    and getBackgroundImage methods, so the two can be swapped.
+
+    The background starts as the first frame, and then every update moves
+    each pixel of it one gray level towards each frame seen since the last
+    update. Over time each pixel settles on the median of what it has
+    seen. A pixel is foreground (255) if it differs from the background by
+    more than threshold.
+
+    The background is only updated every update_every frames, so the frames
+    in between are all compared with the same background. This lets
+    apply_batch handle a whole batch (T x H x W) of frames with a few numpy
+    operations instead of one call per frame. For the tiny ROI crops, the
+    cost of each call matters much more than the cost per pixel.
+    """
+
+    def __init__(self, threshold=constants.MEDIAN_THRESHOLD, update_every=constants.MEDIAN_UPDATE_EVERY):
+        self.threshold = threshold
+        self.update_every = update_every
+        self.background = None  # int16, so the differences don't overflow
+        self.pending = None  # the sum of the steps towards each frame since the last update
+        self.count = 0  # number of frames seen
+
+    def apply(self, image):
+        """Returns the foreground mask of one grayscale frame."""
+        return self.apply_batch(image[np.newaxis])[0]
+
+    def apply_batch(self, frames):
+        """Returns the foreground masks (T x H x W) of a batch of grayscale
+        frames (T x H x W), in order.
+        """
+        if self.background is None:
+            self.background = frames[0].astype(np.int16)
+            self.pending = np.zeros_like(self.background)
+        masks = np.empty(frames.shape, np.uint8)
+        t = 0
+        while t < len(frames):
+            # the frames up to the next update are all compared with the same background
+            n = min(len(frames) - t, self.update_every - self.count % self.update_every)
+            diff = frames[t:t+n].astype(np.int16)
+            diff -= self.background
+            np.greater(np.abs(diff), self.threshold, out=masks[t:t+n])
+            self.pending += np.sign(diff).sum(axis=0, dtype=np.int16)
+            self.count += n
+            t += n
+            if self.count % self.update_every == 0:
+                self.background += self.pending
+                np.clip(self.background, 0, 255, out=self.background)
+                self.pending[:] = 0
+        masks *= 255
+        return masks
+
+    def getBackgroundImage(self):
+        return None if self.background is None else self.background.astype(np.uint8)
+
+
+def create(model=constants.BACKGROUND_MODEL, threshold=constants.MEDIAN_THRESHOLD,
+           update_every=constants.MEDIAN_UPDATE_EVERY):
+    """Returns a new background model of the given kind (one of MODELS)."""
+    if model == 'knn':
+        return cv2.createBackgroundSubtractorKNN()
+    if model == 'median':
+        return RunningMedian(threshold, update_every)
+    raise ValueError(f'Unknown background model {model}, must be one of {MODELS}')
+
+
+def read_gray_frames(video, count):
+    """Returns up to count grayscale frames of the video, as an array."""
+    cap = open_capture(video)
+    frames = []
+    while len(frames) < count:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+    cap.release()
+    return np.array(frames)
+
+
+def benchmark(frames, batch=8, threshold=constants.MEDIAN_THRESHOLD, update_every=1):
+    """Times each background model on the same frames, and returns a dict
+    from the name of each run to its frames per second.
+    """
+    def run(name, apply):
+        start = time.perf_counter()
+        apply()
+        results[name] = len(frames) / (time.perf_counter() - start)
+
+    results = {}
+    knn = create('knn')
+    run('knn', lambda: [knn.apply(frame) for frame in frames])
+    median = create('median', threshold, update_every)
+    run('median', lambda: [median.apply(frame) for frame in frames])
+    median = create('median', threshold, update_every)
+    run(f'median (batches of {batch})',
+        lambda: [median.apply_batch(frames[i:i+batch]) for i in range(0, len(frames), batch)])
+    return results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Compares the speed of the background models on the same '
+                    'frames of a video (e.g. an ROI video from croprotate.py).')
+    arg_parser.add_argument('video',
+                            type=str,
+                            help='The video (or segment manifest) to read the frames from.')
+    arg_parser.add_argument('-n', '--frames',
+                            dest='frames',
+                            type=int,
+                            default=1000,
+                            help='The number of frames to use (default 1000).')
+    arg_parser.add_argument('-b', '--batch',
+                            dest='batch',
+                            type=int,
+                            default=8,
+                            help='The number of frames in each batch (default 8).')
+    arg_parser.add_argument('-mt', '--median-threshold',
+                            dest='median_threshold',
+                            type=int,
+                            default=constants.MEDIAN_THRESHOLD,
+                            help='The threshold of the median model '
+                                 f'(default {constants.MEDIAN_THRESHOLD}).')
+    arg_parser.add_argument('-mu', '--median-update-every',
+                            dest='median_update_every',
+                            type=int,
+                            default=1,
+                            help='How often the median model is updated, in '
+                                 'frames (default 1).')
+    args = arg_parser.parse_args()
+    frames = read_gray_frames(args.video, args.frames)
+    print(f'{len(frames)} frames of {frames.shape[2]}x{frames.shape[1]}')
+    for name, fps in benchmark(frames, args.batch, args.median_threshold,
+                               args.median_update_every).items():
+        print(f'{name}: {fps:.0f} frames per second')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from math import cos, sin, pi
+from math import cos, sin, pi, ceil
 import numpy as np
 import cv2
 import os, os.path
@@ -149,6 +149,43 @@ class BBox:
         height = self.h*np.array((sin(self.a), cos(self.a)))
         return [ulc, ulc+height, ulc+width+height, ulc+width]
 
+    @property
+    def crop_size(self):
+        """Returns the (width, height) of the cropped ROI video, which is
+        the bounding box rounded up to even dimensions.
+        """
+        return tuple(2*ceil(x/2) for x in (self.w, self.h))
+
+    def crop_maps(self):
+        """Returns a pair of float32 arrays (map_x, map_y) of shape
+        (height, width) which can be passed to cv2.remap to pull the
+        rotated bounding box straight out of a full frame of the video.
+
+        The result has the same orientation and size as the ROI videos
+        made by croprotate.py.
+        """
+        width, height = self.crop_size
+        u, v = np.meshgrid(np.arange(width), np.arange(height))
+        map_x = self.x + u*cos(self.a) + v*sin(self.a)
+        map_y = self.y - u*sin(self.a) + v*cos(self.a)
+        return map_x.astype(np.float32), map_y.astype(np.float32)
+
+    def crop_mask(self, padding=0):
+        """Returns a uint8 array of shape (height, width), the same as
+        crop_maps, which is 255 inside the ROI's polygon and 0 outside it.
+
+        If padding is given, the polygon is grown by that many pixels, so
+        that ants leaving across its edges can still be followed for a bit.
+        """
+        width, height = self.crop_size
+        mask = np.zeros((height, width), np.uint8)
+        verts = np.round(np.array(self.poly_relpos)).astype(np.int32)
+        cv2.fillPoly(mask, [verts], 255)
+        if padding:
+            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2*padding+1, 2*padding+1))
+            mask = cv2.dilate(mask, kernel)
+        return mask
+
 def read_bboxes(filename):
     """Loads the given file and returns a list of BBox objects for the
     ROIs defined in the file.
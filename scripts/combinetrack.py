@@ -1,11 +1,25 @@
 import argparse
+import csv
 import os, os.path
 import collections
 import constants
 
-def combine_split_track(tracks, outfile, min_duration, count_warning_threshold, split_length=600):
+def read_segment_offsets(segments_file):
+    """Reads the segments.csv written by split.py and returns a dict from
+    each segment number to its start time in the original video.
+    """
+    with open(segments_file, newline='') as f:
+        return {int(row['segment']): float(row['start_time'])
+                for row in csv.DictReader(f)}
+
+def combine_split_track(tracks, outfile, min_duration, count_warning_threshold, split_length=600,
+                        offsets=None):
     """Combines a list of tracks (specified via filenames) into one
     file, at the location specified by outfile.
+
+    If offsets is given, it maps each split number (the name of the
+    directory each track file is in) to the time at which that split
+    starts. Otherwise, split i is assumed to start at split_length*i.
     """
 
     # filename,id,x0,y0,t0,x1,y1,t1,begin_middle,end_middle,merge_id,
@@ -59,8 +73,12 @@ def combine_split_track(tracks, outfile, min_duration, count_warning_threshold,
             # IMPORTANT! THIS IS WHERE YOU DEAL WITH MERGERS AND UNMERGERS!!!
             # TODO: WRITE CODE HERE!!!
 
-            t0 = round(split_length*i + float(line[4]), 2)
-            t1 = round(split_length*i + float(line[7]), 2)
+            if offsets is not None:
+                offset = offsets[int(os.path.basename(os.path.dirname(infile)))]
+            else:
+                offset = split_length*i
+            t0 = round(offset + float(line[4]), 2)
+            t1 = round(offset + float(line[7]), 2)
             line[4] = "{minute0}.{second0:02d}".format(minute0 = int(t0//60), second0 = int(t0%60))
             line[7] = "{minute1}.{second1:02d}".format(minute1 = int(t1//60), second1 = int(t1%60))
 
@@ -106,11 +124,24 @@ def main():
                                  'to output a warning and flag the offending '
                                  'ants.'
                      )
+    args.add_argument('-o', '--offsets',
+                            dest='offsets',
+                            type=str,
+                            default=None,
+                            help='The segments.csv written by split.py, which '
+                                 'gives the exact start time of each split. '
+                                 'If it is not given or does not exist, each '
+                                 'split is assumed to be 600 seconds long.'
+                     )
     
     args = args.parse_args()
     if args.sort:
         args.infiles.sort()
-    combine_split_track(args.infiles, args.outfile, args.min_duration, args.count_threshold)
+    offsets = None
+    if args.offsets is not None and os.path.exists(args.offsets):
+        offsets = read_segment_offsets(args.offsets)
+    combine_split_track(args.infiles, args.outfile, args.min_duration, args.count_threshold,
+                        offsets=offsets)
 
 if __name__ == '__main__':
     main()
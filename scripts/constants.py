@@ -22,6 +22,9 @@ PADDING = 10                    # This constant was buried in the antTracker.py
 MIN_BLOB = 15                    # The smallest size of blob which is interpreted
                                 # as an ant
 
+MAX_BLOB = 500                  # Blobs of this size or bigger are
+                                # not ants, or even merged ants
+
 COUNT_WARNING_THRESHOLD = 10    # If more ants than this are detected in the
                                 # span of 5 seconds, throw a warning and flag
                                 # the offending tracks
@@ -121,6 +124,76 @@ MERGE_DISTANCE = 10            # The maximum distance allowed
                                 # between two existing tracks
                                 # for it to be considered a merger.
 
+BLOB_METHOD = 'contours'        # How the detector finds the ants
+                                # in the foreground mask: by finding
+                                # the outline of each one
+                                # ('contours') or with connected
+                                # component statistics
+                                # ('components', faster, but its
+                                # areas are pixel counts, so
+                                # MIN_BLOB and MAX_BLOB would need
+                                # recalibrating)
+
+DETECTOR_STAGES = ['background', 'blur']
+                                # The stages the detector runs on
+                                # each frame, in order, before
+                                # finding the blobs. Can be any of
+                                # background, blur, dilate, canny
+                                # and threshold
+
+MOTION_THRESHOLD = 10          # With the motion gate, a frame is
+                                # skipped if no 4x4 block of it
+                                # changed by more than this many
+                                # gray levels since the last
+                                # processed frame (and no ants are
+                                # being tracked)
+
+BACKGROUND_EVERY = 5           # With the motion gate, every nth
+                                # skipped frame is still used to
+                                # update the background model
+
+BACKGROUND_MODEL = 'knn'        # The background model of the
+                                # background stage: OpenCV's KNN
+                                # subtractor ('knn') or a running
+                                # median ('median', see
+                                # background.py)
+
+MEDIAN_THRESHOLD = 25           # With the median model, a pixel
+                                # is foreground if it differs from
+                                # the background by more than this
+                                # many gray levels
+
+MEDIAN_UPDATE_EVERY = 1         # With the median model, the
+                                # background is updated once every
+                                # this many frames
+
+MEDIAN_BATCH = 8                # With the median model (and the
+                                # threaded or fused tracker), this
+                                # many frames go through the
+                                # background model at once
+
+ROI_MASK_PADDING = 5            # With the ROI mask, the ROI's
+                                # polygon is grown by this many
+                                # pixels, so that ants leaving
+                                # across its edges are still
+                                # followed for a bit
+
+ILLUMINATION_MAX_FOREGROUND = 0.3
+                                # With the illumination guard, if
+                                # more than this fraction of a
+                                # frame is foreground, the lighting
+                                # has changed, so the background is
+                                # learnt again
+
+ILLUMINATION_MAX_BLOBS = 50     # With the illumination guard, if
+                                # more ants than this are found on
+                                # a frame, it is treated the same
+
+ILLUMINATION_HOLD = 12          # With the illumination guard, no
+                                # ants are detected for this many
+                                # frames after a change, while the
+                                # new background settles
+
 
 # Parameters used in detecting bridges automatically via looking for red
 # For more information on the HSV color model, go to
@@ -1,12 +1,17 @@
 import subprocess
 import argparse
-from math import sin, cos, ceil
+from math import sin, cos, ceil, floor
 import os
 import os.path
 from concurrent.futures import ProcessPoolExecutor
 
 import metadata
 import bbox
+import segment
+
+# Maps the index of each ROI in the ROI file to the number it is labeled
+# with in the output
+ROI_NAMES = {0:42, 1:122, 2:121, 3:41, 4:12, 5:40, 6:112, 7:8, 8:11, 9:6, 10:10, 11:4, 12:111, 13:2, 14:60, 15:0, 16:1, 17:3, 18:20, 19:7, 20:5, 21:211, 22:31, 23:21, 24:22, 25:30, 26:50, 27:212, 28:222, 29:221, 30:32}
 
 def run_cmd(cmd):
     """Execute the command. A basic helper function for the next line."""
@@ -15,7 +20,40 @@ def run_cmd(cmd):
                             stderr=subprocess.STDOUT).stdout.decode()
     return output 
 
-def crop_video(Dict, video, out_dir, boxes, cores=1, logfile=None):
+def roi_filter(box, H, W, padding=2):
+    """Returns the ffmpeg filter chain which cuts the given bounding box
+    out of a frame of height H and width W, rotated to be flat.
+
+    Rather than rotating the whole frame and then cropping it, this first
+    crops the axis-aligned region around the rotated box (plus padding),
+    and then only rotates that small patch before the final crop.
+    """
+    xs, ys = zip(*box.box_vertices)
+    # The patch is aligned to even pixels, because ffmpeg rounds crop
+    # offsets down to even numbers for subsampled (yuv420p) video.
+    x0 = max(0, 2*floor((min(xs)-padding)/2))
+    y0 = max(0, 2*floor((min(ys)-padding)/2))
+    x1 = min(W, 2*ceil((max(xs)+padding)/2))
+    y1 = min(H, 2*ceil((max(ys)+padding)/2))
+    patch_w, patch_h = x1 - x0, y1 - y0
+    (ulx, uly), (width, height), angle = box.box
+    # ffmpeg rotates about the center of the patch, and places it at the
+    # center of an output canvas of ow x oh (rounded up to even numbers),
+    # so we find where the upper-left corner of the box ends up.
+    # Rotates positive because ffmpeg rotate clockwise and our angle is measured positively
+    # counterclockwise
+    ow = 2*ceil((abs(patch_w*cos(angle)) + abs(patch_h*sin(angle)))/2)
+    oh = 2*ceil((abs(patch_w*sin(angle)) + abs(patch_h*cos(angle)))/2)
+    dx, dy = ulx - x0 - patch_w/2, uly - y0 - patch_h/2
+    new_ulx = dx*cos(angle) - dy*sin(angle) + ow/2
+    new_uly = dx*sin(angle) + dy*cos(angle) + oh/2
+    new_ulx, new_uly, = map(round, (new_ulx, new_uly))
+    width, height = map(lambda x: 2*ceil(x/2), (width, height))
+    return f'crop={patch_w}:{patch_h}:{x0}:{y0}, rotate={angle}:ow={ow}:oh={oh}, ' \
+           f'crop={width}:{height}:{new_ulx}:{new_uly}:exact=1'
+
+def crop_video(Dict, video, out_dir, boxes, cores=1, logfile=None,
+               single_pass=False):
     """Crops the given video, according to boxes, and saves the results
     in out_dir.
 
@@ -28,32 +66,35 @@ def crop_video(Dict, video, out_dir, boxes, cores=1, logfile=None):
     Cores is an optional argument. If specified, it will run this many
     ffmpeg operations in parallel, increasing execution speed. If cores
     is 0, then it will run all operations in parallel.
+
+    If single_pass is True, then the video is decoded only once and all
+    of the ROIs are written by a single ffmpeg process, using a split
+    filter to fan the decoded frames out to each crop. In that case,
+    cores is passed to ffmpeg as its thread count instead.
     """
     if not os.path.isdir(out_dir):
         os.mkdir(out_dir)
-    command = 'ffmpeg -y -i {0} -strict -2 -vf "rotate={1}:' \
-              'ow=ceil(rotw({1})/2)*2:oh=ceil(roth({1})/2)*2, ' \
-              'crop={2}:{3}:{4}:{5}" {6}'
-              # The -strict -2 is here because ffmpeg sometimes insists on
-              # using experimental codices. I don't know why it does that,
-              # but this allows it to continue.
-
-              # Rotates positive because ffmpeg rotate clockwise and our angle is measured positively
-              # counterclockwise 
-    # Format argument order: input video, rotation angle, width, height,
-    #     upper-left x after rotation, upper-left y after rotation, output video
-    video_name = os.path.splitext(os.path.basename(video))[0]
-    H, W = metadata.get_video_dimensions(video)
-    cmds = []
-    for i in range(len(boxes)):
-        (ulx, uly), (width, height), angle = boxes[i].box
-        #Changed to new formula 
-        new_ulx = ulx*cos(angle) - uly*sin(angle) + H*sin(angle)
-        new_uly = ulx*sin(angle)+uly*cos(angle)
-        new_ulx, new_uly, = map(round, (new_ulx, new_uly))
-        width, height = map(lambda x: 2*ceil(x/2), (width, height))
-        outvideo = f'{out_dir}/ROI_{Dict[i]}.mp4'
-        cmds.append(command.format(video, angle, width, height, new_ulx, new_uly, outvideo))
+    # The -strict -2 is here because ffmpeg sometimes insists on
+    # using experimental codices. I don't know why it does that,
+    # but this allows it to continue.
+    # video may be a segment manifest, in which case we seek into its source
+    H, W = metadata.get_video_dimensions(segment.resolve(video)[0])
+    video_input = segment.ffmpeg_input(video)
+    outvideos = [f'{out_dir}/ROI_{Dict[i]}.mp4' for i in range(len(boxes))]
+    filters = [roi_filter(box, H, W) for box in boxes]
+    if single_pass:
+        graph = f'[0:v]split={len(boxes)}' \
+                + ''.join(f'[s{i}]' for i in range(len(boxes))) + '; ' \
+                + '; '.join(f'[s{i}]{filters[i]}[o{i}]'
+                            for i in range(len(boxes)))
+        maps = ' '.join(f'-map "[o{i}]" -strict -2 {outvideos[i]}'
+                        for i in range(len(boxes)))
+        threads = f'-threads {cores} ' if cores else ''
+        cmds = [f'ffmpeg -y {threads}{video_input} -filter_complex "{graph}" {maps}']
+        cores = 1
+    else:
+        cmds = [f'ffmpeg -y {video_input} -strict -2 -vf "{filters[i]}" {outvideos[i]}'
+                for i in range(len(boxes))]
     if cores == 0:
         cores = len(cmds)
     outputs = list(ProcessPoolExecutor(max_workers=cores).map(run_cmd, cmds))
@@ -64,7 +105,7 @@ def main():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('video',
                             type=str,
-                            help='The video to be cropped')
+                            help='The video (or segment manifest) to be cropped')
     arg_parser.add_argument('out_dir',
                             type=str,
                             help='The directory in which to save the '
@@ -81,10 +122,16 @@ def main():
                                  'default 1. If multiple cores are specified, '
                                  'then multiple crops will be done in '
                                  'parallel.')
-    Dict = {0:42, 1:122, 2:121, 3:41, 4:12, 5:40, 6:112, 7:8, 8:11, 9:6, 10:10, 11:4, 12:111, 13:2, 14:60, 15:0, 16:1, 17:3, 18:20, 19:7, 20:5, 21:211, 22:31, 23:21, 24:22, 25:30, 26:50, 27:212, 28:222, 29:221, 30:32}
+    arg_parser.add_argument('-s', '--single-pass',
+                            dest='single_pass',
+                            action='store_true',
+                            help='Decode the video only once and write all '
+                                 'of the ROIs from one ffmpeg process, '
+                                 'instead of running one ffmpeg process '
+                                 'per ROI.')
     args = arg_parser.parse_args()
-    crop_video(Dict, args.video, args.out_dir, bbox.read_bboxes(args.boxes),
-               cores=args.cores)
+    crop_video(ROI_NAMES, args.video, args.out_dir, bbox.read_bboxes(args.boxes),
+               cores=args.cores, single_pass=args.single_pass)
 
 if __name__ == '__main__':
     main()
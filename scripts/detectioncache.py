@@ -0,0 +1,89 @@
+import os, os.path
+
+import numpy as np
+
+# A detection cache holds everything the tracker is given while tracking a
+# clip: the timestamp of every frame, and the centers and areas of the ants
+# detected on it. The tracker can then be run again from the cache (see
+# replayClip in track_one_clip.py) with different settings, without decoding
+# the video or detecting anything. The cache is a compressed numpy archive,
+# which stores each of these as one column for the whole clip:
+#     source, fps, width, height  the clip which was tracked
+#     times   (F,)    the timestamp of each frame, in order
+#     counts  (F,)    the number of detections on each frame, or -1 if the
+#                     frame wasn't tracked at all (e.g. the motion gate
+#                     skipped it)
+#     centers (N, 2)  the (x, y) of every detection, frame after frame
+#     areas   (N,)    the area of every detection
+CACHE_EXT = '.npz'
+
+
+class DetectionWriter:
+    """Saves the detections of every frame of a clip, as they are given to
+    the tracker, to a detection cache at path.
+    """
+
+    def __init__(self, path, source, fps, width, height):
+        self.path = path
+        self.source = source
+        self.fps = fps
+        self.size = (width, height)
+        self.times = []
+        self.counts = []
+        self.centers = []
+        self.areas = []
+
+    def log(self, timestamp, detections):
+        """Records the next frame: its timestamp, and its (centers, areas),
+        or None if it wasn't tracked.
+        """
+        self.times.append(timestamp)
+        if detections is None:
+            self.counts.append(-1)
+            return
+        centers, areas = detections
+        self.counts.append(len(centers))
+        if len(centers):
+            self.centers.append(np.array(centers, np.float32).reshape(-1, 2))
+            self.areas.append(np.array(areas, np.float64).reshape(-1))
+
+    def close(self):
+        if not os.path.isdir(os.path.dirname(os.path.abspath(self.path))):
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)))
+        np.savez_compressed(
+            self.path, source=self.source, fps=self.fps,
+            width=self.size[0], height=self.size[1],
+            times=np.array(self.times, np.float64), counts=np.array(self.counts, np.int32),
+            centers=np.concatenate(self.centers) if self.centers else np.empty((0, 2), np.float32),
+            areas=np.concatenate(self.areas) if self.areas else np.empty(0))
+
+
+class DetectionCache:
+    """Reads a detection cache saved by a DetectionWriter."""
+
+    def __init__(self, path):
+        with np.load(path) as data:
+            self.source = str(data['source'])
+            self.fps = float(data['fps'])
+            self.width, self.height = int(data['width']), int(data['height'])
+            self.times = data['times']
+            self.counts = data['counts']
+            self.centers = data['centers']
+            self.areas = data['areas']
+        # where the detections of each frame start
+        self.offsets = np.concatenate(([0], np.cumsum(np.maximum(self.counts, 0))))
+
+    def __len__(self):
+        return len(self.times)
+
+    def frames(self):
+        """Yields (frame number, timestamp, detections) for every frame, in
+        order, where detections is (centers, areas), or None if the frame
+        wasn't tracked.
+        """
+        for i, (timestamp, count) in enumerate(zip(self.times.tolist(), self.counts.tolist())):
+            if count < 0:
+                yield i, timestamp, None
+            else:
+                start, end = self.offsets[i], self.offsets[i+1]
+                yield i, timestamp, (self.centers[start:end], self.areas[start:end])
@@ -1,9 +1,15 @@
 # Borrowed Heavily From Srini Ananthakrishnan's Multi Object Tracking Model
 # https://github.com/srianant/kalman_filter_multi_object_tracking
 
+import collections
+import os, os.path
+import time
+
 import numpy as np
 import cv2
 
+import background
+
 dis_vid = True
 toDisplay = False
 
@@ -28,9 +34,50 @@ def display(frame, description):
     cv2.imshow(description, resized_frame)
 
 
+# the ways Detector can find the blobs (ants) in the foreground mask
+BLOB_METHODS = ('components', 'contours')
+
+# the stages the detector can run on each (grayscale) frame, in the order given to Detector,
+# before finding the blobs in the result. each one is the Detector method stage_<name>
+STAGES = ('background', 'blur', 'dilate', 'canny', 'threshold')
+
+
+# the pixels of an ROI's crop which are inside its polygon (see BBox.crop_mask). the background
+# models work pixel by pixel, so they can be given just the pixels inside the polygon, packed
+# one after the other into rows, instead of the whole rectangle around it. nothing outside the
+# polygon is then modelled or detected, which saves time and leaves out the leaves, shadows and
+# other branches in the corners of the crop
+class RoiMask:
+    WIDTH = 256  # the width of the rows the pixels are packed into
+
+    def __init__(self, mask):
+        self.mask = mask  # 255 inside the polygon, 0 outside
+        self.inside = np.flatnonzero(mask)  # the (flat) index of each pixel inside the polygon
+        rows = max(-(-len(self.inside) // self.WIDTH), 1)
+        # the space after the last pixel stays black, so it is always background
+        self.packed = np.zeros((rows, self.WIDTH), np.uint8)
+
+    # returns the pixels of the image inside the polygon, packed into rows. the same buffer
+    # is returned every time, so it must be used before the next call
+    def pack(self, image):
+        np.take(image, self.inside, out=self.packed.reshape(-1)[:len(self.inside)])
+        return self.packed
+
+    # returns the crop whose pixels inside the polygon are the packed ones, and black elsewhere
+    def unpack(self, packed):
+        image = np.zeros(self.mask.shape, packed.dtype)
+        image.reshape(-1)[self.inside] = packed.reshape(-1)[:len(self.inside)]
+        return image
+
+
 class Detector:
-    def __init__(self, minBlob, num_gaussians, canny_threshold_one, canny_threshold_two, canny_aperture_size, thresholding_threshold, dilating_matrix):
-        self.backRemove = cv2.createBackgroundSubtractorKNN()
+    def __init__(self, minBlob, num_gaussians, canny_threshold_one, canny_threshold_two, canny_aperture_size, thresholding_threshold, dilating_matrix,
+                 blob_method='contours', debug=False, stages=('background', 'blur'),
+                 background_model='knn', median_threshold=25, median_update_every=1, mask=None,
+                 max_blob=500):
+        # the background model of the background stage, one of background.MODELS
+        self.background_model = (background_model, median_threshold, median_update_every)
+        self.backRemove = background.create(*self.background_model)
         self.minBlob = minBlob
         self.num_gaussians = num_gaussians
         self.canny_threshold_one = canny_threshold_one
@@ -38,62 +85,388 @@ class Detector:
         self.canny_aperture_size = canny_aperture_size
         self.thresholding_threshold = thresholding_threshold
         self.dilating_matrix = dilating_matrix
+        self.blob_method = blob_method  # one of BLOB_METHODS
+        self.max_blob = max_blob  # blobs this big (or bigger) aren't ants, or even merged ants
+        self.debug = debug  # if true, draw the blobs found on each frame and display them
+        # if a mask of the ROI's polygon is given, only the pixels inside it are looked at
+        self.roi_mask = RoiMask(mask) if mask is not None else None
+
+        # only the stages which are asked for are run, so e.g. canny and threshold (whose outputs
+        # used to be computed and thrown away) cost nothing unless they are part of the chain
+        for stage in stages:
+            if stage not in STAGES:
+                raise ValueError(f'Unknown detector stage {stage}, must be one of {STAGES}')
+        self.stages = [(stage, getattr(self, 'stage_' + stage)) for stage in stages]
+        self.kernel = cv2.getStructuringElement(
+            cv2.MORPH_ELLIPSE, (self.dilating_matrix, self.dilating_matrix))  # for dilating
+
+        # the total time (in seconds) spent in each stage, and the number of frames detected
+        self.timings = collections.defaultdict(float)
+        self.frames = 0
+
+        # the last grayscale frame, and the fraction of its pixels (inside the ROI's polygon, if
+        # there is a mask) which were foreground. used by IlluminationGuard
+        self.gray = None
+        self.foreground_fraction = 0.0
+        # the output of the background stage on the last frame (see maskcache.py)
+        self.foreground = None
+
+    # whether the background stage can be run on batches of frames (see background_batch): it
+    # has to be the first stage, and the background model has to take batches (RunningMedian)
+    def can_batch(self):
+        return (bool(self.stages) and self.stages[0][0] == 'background'
+                and hasattr(self.backRemove, 'apply_batch'))
+
+    # runs the background stage on a batch of frames (in order) with one call to the background
+    # model, and returns the foreground mask of each one. each frame is then detected with
+    # Detect(frame, foreground), which goes on from the stage after the background. the masks
+    # are the same as running the frames through Detect one at a time, but gray is left as the
+    # last frame of the batch (nothing resets the background in the middle of a batch)
+    def background_batch(self, frames):
+        start = time.perf_counter()
+        grays = [frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                 for frame in frames]
+        start = self.time_stage('gray', start)
+        self.gray = grays[-1]
+        if self.roi_mask is not None:
+            # pack puts every frame into the same buffer, so each one is copied out of it
+            packed = self.backRemove.apply_batch(np.array([self.roi_mask.pack(gray).copy()
+                                                           for gray in grays]))
+            masks = [self.roi_mask.unpack(mask) for mask in packed]
+        else:
+            masks = list(self.backRemove.apply_batch(np.array(grays)))
+        self.time_stage('background', start)
+        return masks
 
-    def Detect(self, frame):
+    # returns (centers, areas): an (M, 2) float32 array with the (rounded) center (x, y) of each
+    # ant found on the frame, and an (M,) array with the area of each one. if the foreground
+    # of the frame is given (from background_batch), the background stage is skipped
+    def Detect(self, frame, foreground=None):
         # display(frame, "original")
+        start = time.perf_counter()
 
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)  # grayscale
-        # display(gray, "grayscale")
+        stages = self.stages
+        if foreground is not None:
+            # background_batch has already done the grayscale and background stages
+            self.foreground = image = foreground
+            stages = stages[1:]
+        else:
+            # frames from the ffmpeg-gray reader are already grayscale
+            image = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)  # grayscale
+            self.gray = image
+            # display(image, "grayscale")
+            start = self.time_stage('gray', start)
 
-        backSub = self.backRemove.apply(gray)  # background subs
-        # display(backSub, "background substitution")
+        for name, stage in stages:
+            image = stage(image)
+            # display(image, name)
+            start = self.time_stage(name, start)
 
-        img_blur = cv2.GaussianBlur(backSub, (self.num_gaussians, self.num_gaussians), 0)  # blur  # should be 3
-        # display(img_blur, "blur")
+        # the stages after the background (e.g. blur) may spill over the edge of the polygon
+        if self.roi_mask is not None:
+            image = cv2.bitwise_and(image, self.roi_mask.mask)
+            start = self.time_stage('mask', start)
 
-        # THERE IS A DILATION STEP BELOW THAT WAS IMPLEMENTED BUT NOT USED
-        # SOURCE: https://docs.opencv.org/3.4/db/df6/tutorial_erosion_dilatation.html
-        # kernel = cv2.getStructuringElement(
-        #     cv2.MORPH_ELLIPSE, (self.dilating_matrix, self.dilating_matrix))  # dilating (closing contours)
-        # dilated = cv2.dilate(img_blur, kernel)
-        # display(dilated, "dilated")
-        
-        dilated = img_blur  # if using dilation step, remove this
+        pixels = image.size if self.roi_mask is None else len(self.roi_mask.inside)
+        self.foreground_fraction = cv2.countNonZero(image) / max(pixels, 1)
 
-        edges = cv2.Canny(dilated, self.canny_threshold_one, self.canny_threshold_two, self.canny_aperture_size)  # edge detection
-        # display(edges, "edges")
+        if self.blob_method == 'components':
+            centers, areas, circles = self.find_components(image)
+        else:
+            centers, areas, circles = self.find_contours(image)
+        self.time_stage('blobs', start)
+        self.frames += 1
 
-        _, thresh = cv2.threshold(edges, self.thresholding_threshold, 255, 0)  # thresholding
-        # display(thresh, "thresh")
+        if self.debug:
+            self.draw_blobs(frame, circles)
 
+        return centers, areas
+
+    # adds the time since start to the given stage, and returns the time now
+    def time_stage(self, name, start):
+        now = time.perf_counter()
+        self.timings[name] += now - start
+        return now
+
+    # prints the average time per frame spent in each stage
+    def report_timing(self, source):
+        if not self.frames:
+            return
+        stages = ', '.join(f'{name} {1000 * total / self.frames:.3f}'
+                           for name, total in self.timings.items())
+        print(f'Detector ms per frame of {source}: {stages}')
+
+    def stage_background(self, image):
+        if self.roi_mask is not None:
+            # only the pixels inside the polygon go through the background model
+            self.foreground = self.roi_mask.unpack(self.backRemove.apply(self.roi_mask.pack(image)))
+        else:
+            self.foreground = self.backRemove.apply(image)  # background subs
+        return self.foreground
+
+    def stage_blur(self, image):
+        return cv2.GaussianBlur(image, (self.num_gaussians, self.num_gaussians), 0)  # blur  # should be 3
+
+    # SOURCE: https://docs.opencv.org/3.4/db/df6/tutorial_erosion_dilatation.html
+    def stage_dilate(self, image):
+        return cv2.dilate(image, self.kernel)  # dilating (closing contours)
+
+    def stage_canny(self, image):
+        return cv2.Canny(image, self.canny_threshold_one, self.canny_threshold_two,
+                         apertureSize=self.canny_aperture_size)  # edge detection
+
+    def stage_threshold(self, image):
+        _, thresh = cv2.threshold(image, self.thresholding_threshold, 255, 0)  # thresholding
+        return thresh
+
+    # finds the blobs with one call to connectedComponentsWithStats, which gives the
+    # centroid, area (in pixels) and bounding box of every blob at once, and keeps the
+    # ones of the right size. much faster than find_contours when there are many blobs
+    def find_components(self, dilated):
+        if not cv2.countNonZero(dilated):  # nothing moved, so there are no blobs
+            return np.empty((0, 2), np.float32), np.empty(0), []
+        # 16 bit labels are quicker, as long as there can't be more blobs than fit in them
+        # (with 8-connectivity, at most one blob in each 2x2 square)
+        height, width = dilated.shape
+        ltype = cv2.CV_16U if ((height+1)//2) * ((width+1)//2) < 2**16 else cv2.CV_32S
+        _, _, stats, centroids = cv2.connectedComponentsWithStats(dilated, connectivity=8, ltype=ltype)
+        # label 0 is the background
+        areas = stats[1:, cv2.CC_STAT_AREA].astype(np.float64)
+        # the area has to be at least minBlob. anything more than max_blob (500) is definitely
+        # NOT an ant and definitely isn't a merger of ants
+        keep = (areas > self.minBlob) & (areas < self.max_blob)
+        centers = np.ascontiguousarray(np.round(centroids[1:][keep]), dtype=np.float32)
+        circles = None
+        if self.debug:
+            boxes = stats[1:][keep]
+            radii = np.maximum(boxes[:, cv2.CC_STAT_WIDTH], boxes[:, cv2.CC_STAT_HEIGHT]) // 2
+            circles = list(zip(centers.astype(int).tolist(), radii.tolist()))
+        return centers, areas[keep], circles
+
+    # finds the blobs by finding the outline of each one, with the center of the smallest
+    # circle around it and the area inside the outline (the original way of doing it)
+    def find_contours(self, dilated):
         contours, _ = cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)  # contours
-        
-        image_with_contours = frame.copy()
 
         centers = []  # center of mass of ant
         areas = []  # area of the center of mass of ant
+        circles = []
 
         for cnt in contours:
-            try:
-
-                (x, y), radius = cv2.minEnclosingCircle(
-                    cnt)  # draws circle around contour
-                area = cv2.contourArea(cnt)  # gets area of contour
-                centeroid, radius = (int(x), int(y)), int(radius)
-
-                red = (0, 0, 255)  # bgr
-                if (500 > area > self.minBlob):  # the area has to be at least minBlob  # 1000 is like a hard limit
-                    # anything more than 500 is definitely NOT an ant and definitely isn't a merger of ants
-                    cv2.circle(image_with_contours, centeroid,
-                               radius, red, 1)
-                    b = np.array([[x], [y]])
-                    centers.append(np.round(b))
-                    areas.append(area)
-            except ZeroDivisionError:
-                pass
+            (x, y), radius = cv2.minEnclosingCircle(cnt)  # draws circle around contour
+            area = cv2.contourArea(cnt)  # gets area of contour
+
+            if (self.max_blob > area > self.minBlob):  # the area has to be at least minBlob  # 1000 is like a hard limit
+                # anything more than max_blob (500) is definitely NOT an ant and definitely isn't a merger of ants
+                centers.append((x, y))
+                areas.append(area)
+                circles.append(((int(x), int(y)), int(radius)))
 
+        centers = np.round(np.array(centers, dtype=np.float64).reshape(-1, 2)).astype(np.float32)
+        return centers, np.array(areas, dtype=np.float64), (circles, contours)
+
+    # draws the blobs which were found (and for contours, all of the outlines) and displays them
+    def draw_blobs(self, frame, circles):
+        image_with_contours = frame.copy()
+        if image_with_contours.ndim == 2:
+            image_with_contours = cv2.cvtColor(image_with_contours, cv2.COLOR_GRAY2BGR)
+        if self.blob_method == 'contours':
+            circles, contours = circles
             green = (0, 255, 0)  # bgr
-            cv2.drawContours(image_with_contours, [cnt], 0, green, 1)
-        # display(image_with_contours, "contours and circles")
+            cv2.drawContours(image_with_contours, contours, -1, green, 1)
+        red = (0, 0, 255)  # bgr
+        for centeroid, radius in circles:
+            cv2.circle(image_with_contours, centeroid, radius, red, 1)
+        display(image_with_contours, "contours and circles")
+        cv2.waitKey(1)
 
-        return centers, areas
+    # saves the background learnt so far to path, so the next split can start from it (see save_background)
+    def save_background(self, path):
+        if 'background' in dict(self.stages):
+            image = self.backRemove.getBackgroundImage()
+            if image is not None and self.roi_mask is not None:
+                image = self.roi_mask.unpack(image)
+            save_background(self.backRemove, path, image)
+
+    # starts the background model from a background saved by save_background, if it fits the frames
+    def warm_start(self, image, shape):
+        if image is not None and image.shape == shape and 'background' in dict(self.stages):
+            warm_start(self.backRemove, image if self.roi_mask is None else self.roi_mask.pack(image))
+
+    # throws away the background model and starts a new one from the last frame detected,
+    # e.g. after the lighting suddenly changed (see IlluminationGuard)
+    def reset_background(self):
+        if 'background' in dict(self.stages) and self.gray is not None:
+            self.backRemove = background.create(*self.background_model)
+            self.warm_start(self.gray, self.gray.shape)
+
+    # feeds a frame to the background model without detecting anything
+    # in it (used for the frames which the motion gate skips). does nothing
+    # if this detector has no background stage (e.g. with SharedBackground)
+    def Learn(self, frame):
+        if 'background' not in dict(self.stages):
+            return
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.stage_background(gray)
+
+
+# the number of times a saved background image is fed to a new background model to warm it up
+WARM_START_FRAMES = 10
+
+
+# OpenCV's background models can't be saved, so instead we save the background they have learnt
+# (as an image) at the end of a split, and start the model for the next split by showing it that
+# image a few times. otherwise the first frames of every split are all foreground, while the new
+# model learns the background from scratch
+def save_background(back_remove, path, image=None):
+    if image is None:
+        image = back_remove.getBackgroundImage()
+    if image is None:
+        # e.g. a RunningMedian which hasn't seen any frames yet
+        print('WARNING: no background has been learnt yet, so none is saved at', path)
+        return
+    if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+        os.makedirs(os.path.dirname(os.path.abspath(path)))
+    cv2.imwrite(path, image)
+
+
+# returns the background image saved at path, or None if there isn't one
+def load_background(path):
+    if not os.path.exists(path):
+        print('WARNING: no saved background at', path)
+        return None
+    return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+
+def warm_start(back_remove, image):
+    for _ in range(WARM_START_FRAMES):
+        back_remove.apply(image)
+
+
+# one background model shared by all of the ROIs, instead of one for each ROI. it is given one
+# image per frame which holds every ROI (e.g. the full frame, or the ROIs cut out and stacked
+# together), and each ROI's detector cuts its own part out of the foreground mask (and so leaves
+# out the background stage). the background then costs one update per frame rather than one per ROI
+class SharedBackground:
+    def __init__(self, model='knn', median_threshold=25, median_update_every=1):
+        self.model = (model, median_threshold, median_update_every)
+        self.backRemove = background.create(*self.model)
+        self.time = 0.0  # the total time (in seconds) spent in apply
+        self.frames = 0
+
+    # returns the foreground mask of the image
+    def apply(self, image):
+        start = time.perf_counter()
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        mask = self.backRemove.apply(gray)
+        self.time += time.perf_counter() - start
+        self.frames += 1
+        return mask
+
+    def background_image(self):
+        return self.backRemove.getBackgroundImage()
+
+    def warm_start(self, image):
+        warm_start(self.backRemove, image)
+
+    # starts a new background model from the image (see Detector.reset_background)
+    def reset(self, image):
+        self.backRemove = background.create(*self.model)
+        self.warm_start(image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+
+    def report_timing(self, source):
+        if self.frames:
+            print(f'Shared background ms per frame of {source}: {1000 * self.time / self.frames:.3f}')
+
+
+# decides which frames can skip detection and tracking because nothing is happening in them.
+# each frame is shrunk by scale (averaging blocks of scale x scale pixels) and compared with the
+# last frame which was processed. if no block changed by more than threshold gray levels, the
+# frame is idle. this is much cheaper than Detect, and most of the time an ROI has no ants in it
+class MotionGate:
+    def __init__(self, threshold, background_every, scale=4):
+        self.threshold = threshold
+        self.background_every = background_every  # feed every nth skipped frame to the background model
+        self.scale = scale
+        self.reference = None  # the shrunken last processed frame
+        self.frames = 0  # number of frames seen
+        self.skipped = 0  # number of frames skipped
+        self.idle_run = 0  # number of frames skipped in a row
+
+    def shrink(self, frame):
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        height, width = gray.shape
+        size = (max(width // self.scale, 1), max(height // self.scale, 1))
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+    # returns True if the frame should be skipped. frames are never skipped while
+    # tracking is True (i.e. while there are tracks in progress), so that every
+    # track still sees every frame until it ends. skipped frames are still fed to
+    # the detector's background model, every background_every frames
+    def skip(self, frame, detector_object, tracking):
+        self.frames += 1
+        small = self.shrink(frame)
+        if not tracking and self.reference is not None \
+                and cv2.absdiff(small, self.reference).max() <= self.threshold:
+            self.skipped += 1
+            self.idle_run += 1
+            if self.idle_run % self.background_every == 0:
+                detector_object.Learn(frame)
+            return True
+        # motion (or tracks in progress), so wake up and process this frame fully
+        self.reference = small
+        self.idle_run = 0
+        return False
+
+    # the fraction of frames which were skipped
+    def skipped_fraction(self):
+        return self.skipped / self.frames if self.frames else 0.0
+
+    def report(self, source):
+        print(f'Motion gate skipped {self.skipped} of {self.frames} frames '
+              f'({100 * self.skipped_fraction():.1f}%) of {source}')
+
+
+# notices sudden changes of the whole frame, e.g. from clouds, lamps or the camera's auto exposure,
+# which make the foreground mask light up at once: more than max_foreground of the pixels are
+# foreground, or more than max_blobs ants are found. on such a frame the detector's background model
+# is learnt again, starting from that frame, and no ants are detected on it or on the next hold
+# frames while the new model settles, so no tracks are made out of the noise. this also bounds the
+# cost of the worst frames, as the tracker never gets more than max_blobs detections. every change
+# is recorded in events, which can be saved with make_events_CSV (see track_one_clip.py)
+class IlluminationGuard:
+    def __init__(self, max_foreground, max_blobs, hold):
+        self.max_foreground = max_foreground
+        self.max_blobs = max_blobs
+        self.hold = hold
+        self.holding = 0  # the number of frames left to hold
+        self.fired = False  # whether the last frame checked was a change
+        self.events = []  # (frame, time, reason, foreground fraction, blobs) of each change
+
+    # given the detections of a frame (from detector_object.Detect), returns them, or no
+    # detections if the frame was (or just followed) a sudden change
+    def check(self, detector_object, detections, frame_number, timestamp):
+        centers, areas = detections
+        self.fired = False
+        if detector_object.frames <= self.hold:
+            return detections  # a new KNN model sees all of its first few frames as foreground
+        if detector_object.foreground_fraction > self.max_foreground:
+            reason = 'foreground'
+        elif len(centers) > self.max_blobs:
+            reason = 'blobs'
+        elif self.holding > 0:
+            self.holding -= 1
+            return np.empty((0, 2), np.float32), np.empty(0)
+        else:
+            return detections
+
+        self.fired = True
+        self.events.append((frame_number, timestamp, reason,
+                            round(detector_object.foreground_fraction, 3), len(centers)))
+        detector_object.reset_background()
+        self.holding = self.hold
+        return np.empty((0, 2), np.float32), np.empty(0)
+
+    def report(self, source):
+        if self.events:
+            print(f'Illumination guard reset the background {len(self.events)} times in {source}')
@@ -0,0 +1,117 @@
+import os, os.path
+import tempfile
+import zipfile
+
+import numpy as np
+
+import metadata
+import segment
+
+# The index of a video is saved next to it, as video + INDEX_SUFFIX
+INDEX_SUFFIX = '.index.npz'
+
+class FrameIndex:
+    """The presentation timestamp (pts) of every frame of a video, plus the
+    byte offset of every keyframe, read once from the container without
+    decoding the video.
+
+    Frames are numbered in presentation order, i.e. the order in which
+    cv2.VideoCapture returns them.
+    """
+
+    def __init__(self, pts, keyframe, pos):
+        self.pts = np.asarray(pts, np.float64)  # pts of each frame, in seconds
+        self.keyframe = np.asarray(keyframe, bool)  # whether each frame is a keyframe
+        self.pos = np.asarray(pos, np.int64)  # byte offset of each frame (-1 if unknown)
+        # for each frame, the number of the last keyframe at or before it
+        self.keyframe_of = np.maximum.accumulate(
+            np.where(self.keyframe, np.arange(len(self.pts)), 0))
+        # the time of each frame, in seconds from the first one (worked out once, as frame_at
+        # searches it on every call)
+        self.times = self.pts - self.pts[0] if len(self.pts) else self.pts.copy()
+
+    @classmethod
+    def build(cls, video):
+        """Builds the index of the given video with ffprobe."""
+        pts, keyframe, pos = zip(*metadata.get_video_packets(video))
+        return cls(pts, keyframe, pos)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['pts'], data['keyframe'], data['pos'])
+
+    def save(self, path):
+        """Saves the index atomically (to a temporary file in the same
+        directory, then moved into place), so that other jobs reading the
+        same video never see a partially written index.
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                   suffix=INDEX_SUFFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, pts=self.pts, keyframe=self.keyframe, pos=self.pos)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def __len__(self):
+        return len(self.pts)
+
+    def timestamps(self):
+        """Returns the time of each frame, in seconds from the first one.
+        The same array is returned every time, so it must not be changed.
+        """
+        return self.times
+
+    def frame_at(self, time):
+        """Returns the number of the frame shown at the given time (in
+        seconds from the first frame).
+        """
+        return max(0, int(np.searchsorted(self.times, time, 'right')) - 1)
+
+    def seek_point(self, frame):
+        """Returns (keyframe, time, pos) for the last keyframe at or before
+        the given frame: its frame number, its time (in seconds from the
+        first frame) and its byte offset. Decoding from there reaches the
+        frame without decoding anything before the keyframe.
+        """
+        key = int(self.keyframe_of[min(frame, len(self.pts)-1)])
+        return key, float(self.pts[key] - self.pts[0]), int(self.pos[key])
+
+
+def index_path(video):
+    return video + INDEX_SUFFIX
+
+def load_index(video):
+    """Returns the FrameIndex of the given video. The first time, it is
+    built and saved next to the video; after that it is just loaded, unless
+    the video has changed since or the saved index can't be read, in which
+    case it is built again.
+    """
+    path = index_path(video)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(video):
+        try:
+            return FrameIndex.load(path)
+        except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            print('Could not read the frame index, building it again:', e)
+    index = FrameIndex.build(video)
+    try:
+        index.save(path)
+    except OSError as e:
+        print('Could not save the frame index:', e)
+    return index
+
+def segment_timestamps(path):
+    """Returns the time of every frame of the given video or segment
+    manifest, in seconds from the start of it, in the order in which
+    segment.SegmentCapture returns them.
+    """
+    source, start, end = segment.resolve(path)
+    times = load_index(source).timestamps()
+    # a tiny tolerance, since ffprobe prints times to the microsecond
+    keep = times >= start - 1e-6
+    if end is not None:
+        keep &= times < end - 1e-6
+    return times[keep] - start
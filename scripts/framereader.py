@@ -0,0 +1,85 @@
+import shlex
+import subprocess
+
+import cv2
+import numpy as np
+
+import metadata
+import segment
+
+# The frame readers which can be chosen with open_capture
+READERS = ('opencv', 'ffmpeg-gray')
+
+class GrayPipeCapture:
+    """A stand-in for cv2.VideoCapture which decodes the video (or segment
+    manifest) with ffmpeg straight to 8-bit grayscale, and reads the raw
+    frames from a pipe.
+
+    This skips the conversion to BGR and back to gray which happens when
+    reading with OpenCV. read() returns the same numpy buffer every time,
+    overwritten with the new frame, so a frame must be used (or copied)
+    before the next one is read, unless a buffer of the right shape is
+    passed to read() to be filled instead.
+    """
+
+    def __init__(self, path, threads=0):
+        source = segment.resolve(path)[0]
+        self.height, self.width = metadata.get_video_dimensions(source)
+        self.fps = metadata.get_video_fps(source)
+        self.frames_read = 0
+        self.buffer = np.empty((self.height, self.width), np.uint8)
+        self._view = memoryview(self.buffer).cast('B')
+        # threads=0 lets ffmpeg pick the number of decoding threads
+        cmd = f'ffmpeg -v error -threads {threads} {segment.ffmpeg_input(path)} ' \
+              '-f rawvideo -pix_fmt gray -'
+        self.process = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE)
+
+    def read(self, image=None):
+        buffer = self.buffer if image is None else image
+        view = self._view if image is None else memoryview(image).cast('B')
+        filled = 0
+        while filled < len(view):
+            n = self.process.stdout.readinto(view[filled:])
+            if not n:
+                return False, None  # the video is over
+            filled += n
+        self.frames_read += 1
+        return True, buffer
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.frames_read
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            # like OpenCV, the time of the frame which was just read. the
+            # pipe doesn't carry timestamps, so for exact (e.g. variable
+            # framerate) times use the frame index instead
+            return max(self.frames_read - 1, 0) * 1000 / self.fps
+        return 0
+
+    def isOpened(self):
+        return self.process.poll() is None or self.process.returncode == 0
+
+    def release(self):
+        self.process.stdout.close()
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+
+
+def open_capture(path, reader='opencv', threads=0):
+    """Opens the given video or segment manifest for reading frames with
+    the chosen reader: 'opencv' reads BGR frames with cv2.VideoCapture,
+    and 'ffmpeg-gray' reads grayscale frames from an ffmpeg pipe, decoding
+    with the given number of threads.
+    """
+    if reader == 'opencv':
+        return segment.SegmentCapture(path)
+    if reader == 'ffmpeg-gray':
+        return GrayPipeCapture(path, threads)
+    raise ValueError(f'Unknown frame reader {reader}, must be one of {READERS}')
@@ -101,3 +101,88 @@ class KalmanFilter(object):
         self.P = self.P - np.dot(K, np.dot(C, K.T))
         self.lastResult = self.u
         return self.u
+
+
+class BatchKalmanFilter(object):
+    """Kalman Filter for many objects at once, with the same model as
+    KalmanFilter. The state vector and covariance of every object are rows
+    of two arrays, so all of them are predicted and corrected together
+    with a few array operations instead of a KalmanFilter per object.
+    Each object is given a slot (its row) by add, which is handed back
+    with remove, and the arrays grow as needed.
+    Attributes: None
+    """
+
+    def __init__(self, capacity=64):
+        """Initialize variable used by Batch Kalman Filter class
+        Args:
+            capacity: the number of slots to start with
+        Return:
+            None
+        """
+        self.dt = 0.005  # delta time
+
+        self.F = np.array([[1.0, self.dt], [0.0, 1.0]])  # state transition mat
+        self.Q = np.eye(2)  # process noise matrix
+        self.R = np.eye(2)  # observation noise matrix
+
+        self.u = np.zeros((capacity, 2, 1))  # state vector of each slot
+        self.P = np.zeros((capacity, 2, 2))  # covariance matrix of each slot
+        self.free = list(range(capacity - 1, -1, -1))  # slots not in use
+
+    def add(self):
+        """Start filtering a new object, in the same initial state as a new
+        KalmanFilter
+        Args:
+            None
+        Return:
+            the object's slot
+        """
+        if not self.free:
+            capacity = len(self.u)
+            self.u = np.concatenate((self.u, np.zeros_like(self.u)))
+            self.P = np.concatenate((self.P, np.zeros_like(self.P)))
+            self.free = list(range(2 * capacity - 1, capacity - 1, -1))
+        slot = self.free.pop()
+        self.u[slot] = 0
+        self.P[slot] = np.diag((3.0, 3.0))
+        return slot
+
+    def remove(self, slot):
+        """Stop filtering the object in slot, so that the slot can be reused
+        Args:
+            slot: the object's slot
+        Return:
+            None
+        """
+        self.free.append(slot)
+
+    def update(self, slots, b, flags):
+        """Predict and then correct the state of the objects in slots, as
+        KalmanFilter.predict followed by KalmanFilter.correct does for one
+        object (see there for the equations).
+        Args:
+            slots: (K,) array of the slots to update
+            b: (K, 2, 1) array of the observation of each object
+            flags: (K,) boolean array, true where the object was observed;
+                   elsewhere the prediction is used as its observation
+        Return:
+            (K, 2, 1) array of the corrected state vector of each object
+        """
+        u = self.u[slots]
+        P = self.P[slots]
+
+        # predict
+        u = np.round(np.matmul(self.F, u))
+        P = np.matmul(self.F, np.matmul(P, self.F.T)) + self.Q
+
+        # correct (A is the identity matrix, so it is left out)
+        b = np.where(flags[:, np.newaxis, np.newaxis], b, u)
+        C = P + self.R
+        K = np.matmul(P, np.linalg.inv(C))
+        u = np.round(u + np.matmul(K, b - u))
+        P = P - np.matmul(K, np.matmul(C, np.swapaxes(K, 1, 2)))
+
+        self.u[slots] = u
+        self.P[slots] = P
+        return u
@@ -0,0 +1,87 @@
+import json
+import os, os.path
+import struct
+import zlib
+
+import numpy as np
+
+# A mask cache holds the foreground mask (the output of the background
+# stage) of every frame of a clip, so that the rest of the detector (blur,
+# finding the blobs, filtering them by size...) can be run again with other
+# settings without decoding the video or learning the background again (see
+# detectMasks in track_one_clip.py).
+#
+# The file starts with one line of json describing the clip:
+#     {"source": ..., "fps": 24.0, "width": 200, "height": 52}
+# followed by one record per frame, in order: its timestamp (float64), the
+# length of its mask (uint32, or SKIPPED if the frame wasn't detected, e.g.
+# the motion gate skipped it), and the mask. The masks of the background
+# models are 0 (background), 127 (shadow, KNN only) or 255 (foreground), so
+# each one is saved as two bit planes, where the pixel is not background and
+# where it is foreground, and compressed. Most of a mask is background, so
+# this is tiny compared to the frame.
+MASK_EXT = '.fgm'
+RECORD = struct.Struct('<dI')
+SKIPPED = 0xFFFFFFFF
+
+
+class MaskWriter:
+    """Saves the foreground mask of every frame of a clip to a mask cache
+    at path.
+    """
+
+    def __init__(self, path, source, fps, width, height):
+        if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        self.file = open(path, 'wb')
+        self.file.write(json.dumps({'source': source, 'fps': fps,
+                                    'width': width, 'height': height}).encode() + b'\n')
+
+    def log(self, timestamp, mask):
+        """Records the next frame: its timestamp and its foreground mask, or
+        None if it wasn't detected.
+        """
+        if mask is None:
+            self.file.write(RECORD.pack(timestamp, SKIPPED))
+            return
+        planes = np.packbits(np.stack((mask > 0, mask == 255)))
+        data = zlib.compress(planes.tobytes(), 1)
+        self.file.write(RECORD.pack(timestamp, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+class MaskCache:
+    """Reads a mask cache saved by a MaskWriter."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+        self.source = header['source']
+        self.fps = header['fps']
+        self.width, self.height = header['width'], header['height']
+
+    def frames(self):
+        """Yields (frame number, timestamp, mask) for every frame, in order,
+        where mask is None if the frame wasn't detected.
+        """
+        pixels = self.width * self.height
+        with open(self.path, 'rb') as f:
+            f.readline()  # the header
+            frame_number = 0
+            while True:
+                record = f.read(RECORD.size)
+                if len(record) < RECORD.size:
+                    break
+                timestamp, length = RECORD.unpack(record)
+                if length == SKIPPED:
+                    yield frame_number, timestamp, None
+                else:
+                    planes = np.unpackbits(np.frombuffer(zlib.decompress(f.read(length)), np.uint8),
+                                           count=2 * pixels).reshape(2, self.height, self.width)
+                    # 127 where it is a shadow, and 127 + 128 = 255 where it is foreground
+                    yield frame_number, timestamp, planes[0] * np.uint8(127) + planes[1] * np.uint8(128)
+                frame_number += 1
@@ -0,0 +1,257 @@
+import argparse
+import csv
+import json
+import os, os.path
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from math import floor, ceil
+
+import constants
+import frameindex
+import overlay
+import segment
+
+# The merge clips of one ROI of one split are listed in a json file in its
+# merger directory, so that they can be cut later (see main) and so that it
+# is easy to see which clip shows which merge:
+#     {"source": ..., "annotated_source": ..., "trace_length": 10,
+#      "result_path": ..., "annotated_result_path": ...,
+#      "clips": [{"name": "ID_3_part_0.mp4", "from_time": 12, "to_time": 31,
+#                 "parts": [[3, 0], [5, 0], [5, 1]],
+#                 "links": ["ID_5_part_0.mp4", "ID_5_part_1.mp4"]}, ...]}
+# where each clip covers the given (id, part) merge intervals of the history
+# csv. Overlapping intervals (of the same ant or different ones) are cut as
+# one clip, instead of once for each of them. The clip is named after its
+# first interval, as ID_{id}_part_{part}.mp4 like every merge clip always
+# was, and the other intervals' names are hard links to it, so every ant
+# still has its own clips.
+MANIFEST_NAME = 'merges.json'
+
+# The most clips cut by one ffmpeg command. Each clip is one more input to
+# ffmpeg, so this keeps the number of open files reasonable
+MAX_CLIPS_PER_CMD = 32
+
+
+def run_cmd(cmd):
+    """Runs the given ffmpeg command and returns its output."""
+    print('About to run:', cmd, sep='')
+    return subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT).stdout.decode()
+
+
+def merge_intervals(history_csv):
+    """Returns the times at which there are merges in the given history
+    csv, as a list of tuples (id, part, from_time, to_time). Each interval
+    goes from a merge to the following unmerge, with 5 seconds of padding.
+    """
+    intervals = []
+
+    # the goal is to "combine" relatively similar times
+    with open(history_csv, 'r') as file:
+        reader = csv.DictReader(file)
+
+        for row in reader:
+            # return merge_time and unmerger_time as a list
+            merge_time = row.get('merge_time').split()
+            unmerge_time = row.get('unmerge_time').split()
+
+            id = row.get('id')
+
+            if len(merge_time) > 0 and len(unmerge_time) > 0:
+                range_of_times = []
+                first_one = True
+                begin_time = 0
+
+                for unmerge in unmerge_time:
+                    unmerge = float(unmerge)
+                    for merge in merge_time:
+                        merge = float(merge)
+                        if first_one:
+                            first_one = False
+                            begin_time = merge
+
+                        # obviously this isn't possible, so we break
+                        if merge > unmerge:
+                            merge_time = merge_time[merge_time.index(str(merge)):]
+                            # first_one = True
+                            break
+
+                    first_one = True
+                    range_of_times.append((floor(begin_time) - 5, ceil(unmerge) + 5))  # we will add 5 seconds of padding
+
+                for part, (from_time, to_time) in enumerate(range_of_times):
+                    intervals.append((int(id), part, max(from_time, 0), to_time))
+
+            else:
+                print("Uh oh, there are more unmerge times and merge times. I don't know what to do!")
+
+    return intervals
+
+
+def coalesce(intervals):
+    """Groups the given (id, part, from_time, to_time) intervals into clips,
+    merging any intervals which overlap. Returns a list of tuples
+    (from_time, to_time, [(id, part), ...]), sorted by time.
+
+    The intervals are sorted by start time and swept once, which is all an
+    interval tree would do for a fixed set of intervals.
+    """
+    clips = []
+    for id, part, from_time, to_time in sorted(intervals, key=lambda x: (x[2], x[3])):
+        if clips and from_time <= clips[-1][1]:
+            clips[-1][1] = max(clips[-1][1], to_time)
+            clips[-1][2].append((id, part))
+        else:
+            clips.append([from_time, to_time, [(id, part)]])
+    return [tuple(clip) for clip in clips]
+
+
+def clip_input(video_source, from_time, to_time):
+    """Returns the ffmpeg input options which read the video from from_time
+    to to_time.
+
+    The seek goes before -i, so ffmpeg jumps straight to the keyframe
+    instead of decoding from the start of the video. Since the clips are
+    stream copied, they have to start on a keyframe anyway, so we seek to
+    the last keyframe before from_time (found using the video's frame
+    index) to keep the whole range. If the video is a segment manifest
+    (e.g. a virtual split tracked by track_split.py), the clip is cut from
+    its source video, with the times moved to the start of the segment.
+    """
+    video_source, start, _ = segment.resolve(video_source)
+    from_time = max(from_time, 0) + start
+    to_time += start
+    try:
+        index = frameindex.load_index(video_source)
+        _, from_time, _ = index.seek_point(index.frame_at(from_time))
+    except RuntimeError:
+        pass  # no index, so let ffmpeg find the keyframe itself
+    return f'-ss {from_time} -t {to_time - from_time} -i {video_source}'
+
+
+def cut_cmds(video_source, clips, result_path):
+    """Returns the ffmpeg commands which stream copy the given clips out of
+    the video into result_path. Each command cuts up to MAX_CLIPS_PER_CMD
+    clips, taking each one from its own (seeked) input.
+    """
+    cmds = []
+    for i in range(0, len(clips), MAX_CLIPS_PER_CMD):
+        chunk = clips[i:i+MAX_CLIPS_PER_CMD]
+        inputs = ' '.join(clip_input(video_source, clip['from_time'], clip['to_time'])
+                          for clip in chunk)
+        outputs = ' '.join(f'-map {n} -c copy {os.path.join(result_path, clip["name"])}'
+                           for n, clip in enumerate(chunk))
+        cmds.append(f'ffmpeg -y -loglevel error {inputs} {outputs}')
+    return cmds
+
+
+def clip_name(id, part):
+    """Returns the file name of the merge clip of the given (id, part)
+    merge interval.
+    """
+    return f'ID_{id}_part_{part}.mp4'
+
+
+def link_clips(clips, result_path):
+    """Gives every merge interval of the given clips its own name in
+    result_path, by hard linking it to the clip which was cut for it (or
+    copying the clip, where hard links aren't supported).
+    """
+    for clip in clips:
+        path = os.path.join(result_path, clip['name'])
+        if not os.path.exists(path):
+            continue  # the clip wasn't cut (e.g. ffmpeg failed)
+        for name in clip.get('links', []):  # manifests from before the links had none
+            link = os.path.join(result_path, name)
+            if os.path.lexists(link):
+                os.remove(link)
+            try:
+                os.link(path, link)
+            except OSError:
+                shutil.copyfile(path, link)
+
+
+def write_manifest(history_csv, video_source, annotated_video_source, result_path,
+                   annotated_result_path, trace_length=constants.TRACKER_TRACE_LENGTH):
+    """Finds the merge clips of a tracked clip and lists them in the merges
+    manifest in result_path. Returns the path of the manifest, or None if
+    there were no merges.
+    """
+    clips = coalesce(merge_intervals(history_csv))
+    if not clips:
+        return None
+    os.makedirs(result_path, exist_ok=True)
+    path = os.path.join(result_path, MANIFEST_NAME)
+    with open(path, 'w') as f:
+        json.dump({'source': video_source,
+                   'annotated_source': annotated_video_source,
+                   'trace_length': trace_length,
+                   'result_path': result_path,
+                   'annotated_result_path': annotated_result_path,
+                   'clips': [{'name': clip_name(*parts[0]), 'from_time': from_time,
+                              'to_time': to_time, 'parts': parts,
+                              'links': [clip_name(*part) for part in parts[1:]]}
+                             for from_time, to_time, parts in clips]},
+                  f, indent=1)
+    return path
+
+
+def cut_clips(manifest_path, cores=1):
+    """Cuts every clip listed in the given merges manifest, from the video
+    and from the annotated video (or renders it from the overlay log), using
+    up to cores worker processes.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    clips = manifest['clips']
+    annotated_source = manifest['annotated_source']
+
+    os.makedirs(manifest['result_path'], exist_ok=True)
+    with ProcessPoolExecutor(max_workers=cores) as executor:
+        jobs = [executor.submit(run_cmd, cmd)
+                for cmd in cut_cmds(manifest['source'], clips, manifest['result_path'])]
+        if annotated_source:
+            os.makedirs(manifest['annotated_result_path'], exist_ok=True)
+            if overlay.is_overlay_log(annotated_source):
+                jobs += [executor.submit(overlay.render, manifest['source'], annotated_source,
+                                         os.path.join(manifest['annotated_result_path'], clip['name']),
+                                         clip['from_time'], clip['to_time'],
+                                         manifest['trace_length'])
+                         for clip in clips]
+            else:
+                jobs += [executor.submit(run_cmd, cmd)
+                         for cmd in cut_cmds(annotated_source, clips,
+                                             manifest['annotated_result_path'])]
+        for job in jobs:
+            output = job.result()
+            if output:
+                print(output, end='')
+
+    link_clips(clips, manifest['result_path'])
+    if annotated_source:
+        link_clips(clips, manifest['annotated_result_path'])
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Cuts the merge clips listed in a merges manifest, which '
+                    'track.py writes instead of cutting them with --defer-merges.')
+    arg_parser.add_argument('manifests',
+                            type=str,
+                            nargs='+',
+                            help='The merges manifests (merger/.../%s) whose '
+                                 'clips to cut.' % MANIFEST_NAME)
+    arg_parser.add_argument('-c', '--cores',
+                            dest='cores',
+                            type=int,
+                            default=1,
+                            help='The number of clips to cut at the same time '
+                                 '(default 1).')
+    args = arg_parser.parse_args()
+    for manifest in args.manifests:
+        cut_clips(manifest, args.cores)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,57 +1,156 @@
+import json
+import os, os.path
 import subprocess
-import re
+import tempfile
+import time
+from fractions import Fraction
 
-height_regex = re.compile(r'^height=([0-9]+)$', re.MULTILINE)
-width_regex = re.compile(r'^width=([0-9]+)$', re.MULTILINE)
-duration_regex = re.compile(r'^duration=([0-9]+[.][0-9]+)$', re.MULTILINE)
-frames_regex = re.compile(r'^nb_frames=([0-9]+)$', re.MULTILINE)
-fps_regex = re.compile(r'^avg_frame_rate=([0-9]+/[0-9]+)$', re.MULTILINE)
+# ffprobe results are cached on disk, keyed by the path, size and
+# modification time of the video, so that each video is only probed once
+# across all of the steps of the pipeline. Only the CACHE_SIZE most
+# recently used videos are kept. The file is only written when a video is
+# probed, so a hit is only counted as a use the next time this process
+# writes it.
+CACHE_FILE = os.environ.get(
+    'ANT_TRACKER_PROBE_CACHE',
+    os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                 'ant_tracker', 'probe.json'))
+CACHE_SIZE = 256
+
+_memory_cache = {}
+_last_used = {}  # the time of the last disk cache hit on each key, since the file was written
+
+def _read_cache():
+    try:
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_cache(cache):
+    """Writes the cache atomically, so that concurrent jobs never see a
+    partially written file. (If two jobs write at once, one of their new
+    entries is lost, which only costs an extra ffprobe later.)
+    """
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(CACHE_FILE))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp, CACHE_FILE)
+    except OSError as e:
+        print('Could not save the ffprobe cache:', e)
+
+def probe(input_video):
+    """Returns ffprobe's description of the given video, as a dict with
+    'format' and 'streams' keys, from a single ffprobe call.
+
+    The result is cached on disk (see CACHE_FILE), keyed by the path, size
+    and modification time of the video, so that it is only recomputed if
+    the video changes.
+    """
+    try:
+        stat = os.stat(input_video)
+    except OSError as e:
+        raise RuntimeError(f'Cannot probe {input_video}: {e}') from e
+    key = f'{os.path.abspath(input_video)}:{stat.st_size}:{stat.st_mtime_ns}'
+    if key in _memory_cache:
+        return _memory_cache[key]
+
+    cache = _read_cache()
+    if key in cache:
+        # the file isn't rewritten just to move the key up the LRU order
+        result = _memory_cache[key] = cache[key]['probe']
+        _last_used[key] = time.time()
+        return result
+
+    cmd = ['ffprobe', '-v', 'error', '-of', 'json',
+           '-show_format', '-show_streams', input_video]
+    # stderr is kept apart, so that warnings can't get mixed into the json
+    process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = process.stdout.decode()
+    try:
+        result = json.loads(output)
+        result['format'], result['streams']
+    except (ValueError, KeyError) as e:
+        raise RuntimeError('Unparsable ffprobe output:\n{}{}\nfrom command:\n{}'\
+                           .format(output, process.stderr.decode(), ' '.join(cmd))) from e
+
+    # the file is being written anyway, so the hits since it was last written count as uses now
+    for used_key, used in _last_used.items():
+        if used_key in cache:
+            cache[used_key]['used'] = max(cache[used_key]['used'], used)
+    _last_used.clear()
+    cache[key] = {'used': time.time(), 'probe': result}
+    if len(cache) > CACHE_SIZE:
+        for old_key in sorted(cache, key=lambda k: cache[k]['used'])[:-CACHE_SIZE]:
+            del cache[old_key]
+    _write_cache(cache)
+    _memory_cache[key] = result
+    return result
+
+def _video_stream(input_video):
+    """Returns the probed info of the first video stream in the video."""
+    for stream in probe(input_video)['streams']:
+        if stream.get('codec_type') == 'video':
+            return stream
+    raise RuntimeError(f'No video stream found in {input_video}')
 
 def get_video_dimensions(input_video):
     """Takes a path to a video file and returns a tuple containing the
     video's height and width in that order.
     """
-    cmd = f'ffprobe -show_streams {input_video}'.split()
-    output = subprocess.run(cmd, stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT).stdout.decode()
-    try:
-        height = int(re.search(height_regex, output).group(1))
-        width = int(re.search(width_regex, output).group(1))
-    except AttributeError as e:
-        raise RuntimeError('Unparsable ffprobe output:\n%s\n\nfrom command:\n%s'
-                            % (output, ' '.join(cmd))) from e
-    return height, width
+    stream = _video_stream(input_video)
+    return int(stream['height']), int(stream['width'])
 
 def get_video_duration(input_video):
     """Returns the duration of the given video."""
-    cmd = f'ffprobe -show_streams {input_video}'.split()
-    output = subprocess.run(cmd, stdout=subprocess.PIPE,
-                           stderr=subprocess.STDOUT).stdout.decode()
+    stream = _video_stream(input_video)
     try:
-        return float(re.search(duration_regex, output).group(1))
-    except AttributeError as e:
-        raise RuntimeError('Unparsable ffprobe output:\n{}\nfrom command:\n{}'\
-                           .format(output, ' '.join(cmd))) from e
+        # only fall back on the container's duration if the stream has none
+        if 'duration' in stream:
+            return float(stream['duration'])
+        return float(probe(input_video)['format']['duration'])
+    except KeyError as e:
+        raise RuntimeError(f'No duration found for {input_video}') from e
     
 def get_video_frames(input_video):
     """Returns the number of frames in the given video."""
-    cmd = f'ffprobe -show_streams {input_video}'.split()
-    output = subprocess.run(cmd, stdout=subprocess.PIPE,
-                           stderr=subprocess.STDOUT).stdout.decode()
     try:
-        return int(re.search(frames_regex, output).group(1))
-    except AttributeError as e:
-        raise RuntimeError('Unparsable ffprobe output:\n{}\nfrom command:\n{}'\
-                           .format(output, ' '.join(cmd))) from e
+        return int(_video_stream(input_video)['nb_frames'])
+    except KeyError as e:
+        raise RuntimeError(f'No frame count found for {input_video}') from e
 
 def get_video_fps(input_video):
     """Returns the average framerate in the given video."""
-    cmd = f'ffprobe -show_streams {input_video}'.split()
-    output = subprocess.run(cmd, stdout=subprocess.PIPE,
-                           stderr=subprocess.STDOUT).stdout.decode()
     try:
-        return eval(re.search(fps_regex, output).group(1))
-    except AttributeError as e:
-        raise RuntimeError('Unparsable ffprobe output:\n{}\nfrom command:\n{}'\
-                           .format(output, ' '.join(cmd))) from e
+        return float(Fraction(_video_stream(input_video)['avg_frame_rate']))
+    except (KeyError, ValueError, ZeroDivisionError) as e:
+        raise RuntimeError(f'No framerate found for {input_video}') from e
 
+def get_video_packets(input_video):
+    """Returns a list of (pts, keyframe, pos) tuples for the packets of the
+    first video stream of the given video, sorted by presentation time,
+    where pts is in seconds, keyframe is True for keyframes and pos is the
+    byte offset of the packet in the file (-1 if unknown).
+
+    This only reads the container, so it doesn't decode the video.
+    """
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'packet=pts_time,pos,flags', '-of', 'csv=p=0',
+           input_video]
+    process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = process.stdout.decode()
+    packets = []
+    for line in output.split():
+        pts, pos, flags = (line.split(',') + ['', ''])[:3]
+        try:
+            pts = float(pts)
+        except ValueError:
+            continue  # packets without a pts (N/A) can't be cut on
+        packets.append((pts, 'K' in flags, int(pos) if pos.isdigit() else -1))
+    if not packets:
+        raise RuntimeError('Unparsable ffprobe output:\n{}{}\nfrom command:\n{}'\
+                           .format(output, process.stderr.decode(), ' '.join(cmd)))
+    packets.sort()
+    return packets
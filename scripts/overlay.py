@@ -0,0 +1,194 @@
+import argparse
+import collections
+import csv
+import os, os.path
+
+import cv2
+
+import constants
+from framereader import open_capture
+
+# An overlay log records what would be drawn on each frame of an annotated
+# video: the timestamp, and the id and latest position of every active track.
+# Tracking writes this instead of encoding the annotated video, and render()
+# draws the annotations later, only for the clips (or time ranges) which are
+# actually wanted. Each row is one frame, with the ids and positions of its
+# tracks as space separated lists (like merge_id and merge_time in the
+# history csvs), and whether the tracks are drawn on it:
+#     frame,time,drawn,ids,x,y
+#     57,2.38,1,3 4,51 12,20 33
+# While tracking, the tracker only runs (and the traces only grow) on frames
+# where ants were detected, and the tracks are only drawn on those frames,
+# so the other frames are logged with drawn 0 and no tracks, and only get
+# their timestamp.
+OVERLAY_EXT = '.csv'
+HEADERS = ['frame', 'time', 'drawn', 'ids', 'x', 'y']
+
+track_colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0),
+                (0, 255, 255), (255, 0, 255), (255, 127, 255),
+                (127, 0, 255), (127, 0, 127)]
+
+
+def is_overlay_log(path):
+    """Returns whether the given path is an overlay log rather than an
+    annotated video.
+    """
+    return os.path.splitext(path)[1] == OVERLAY_EXT
+
+
+def draw_timestamp(frame, timestamp):
+    """Puts the timestamp in the top left corner of the frame."""
+    cv2.putText(frame, str(timestamp), (0, 10), cv2.FONT_HERSHEY_SIMPLEX, .4, (0, 255, 0), 2)
+
+
+def draw_trace(frame, track_id, trace):
+    """Draws the trace of one track (a list of (x, y) points, oldest
+    first) onto the frame, with the track's id at each point.
+    """
+    clr = track_id % 9
+    for (x1, y1), (x2, y2) in zip(trace, trace[1:]):
+        cv2.line(frame, (x1, y1), (x2, y2), track_colors[clr], 1)
+        cv2.putText(frame, str(track_id), (x2, y2),
+                    cv2.FONT_HERSHEY_SIMPLEX, .5, track_colors[clr], 1, cv2.LINE_AA)
+
+
+class OverlayLog:
+    """Writes the overlay log of one clip, one frame at a time."""
+
+    def __init__(self, path):
+        if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(HEADERS)
+
+    def log(self, frame_number, timestamp, tracker_object, drawn):
+        """Records the given frame: its timestamp, and if drawn (the tracker
+        ran on it), the latest point of the trace of every active track.
+        """
+        tracks = [track for track in tracker_object.tracks if len(track.trace) > 0] if drawn else []
+        self.writer.writerow([
+            frame_number, timestamp, int(drawn),
+            ' '.join(str(track.track_id) for track in tracks),
+            ' '.join(str(int(track.trace[-1][0][0])) for track in tracks),
+            ' '.join(str(int(track.trace[-1][1][0])) for track in tracks)])
+
+    def close(self):
+        self.file.close()
+
+
+def read_overlay_log(path):
+    """Returns the rows of an overlay log, as a list of tuples
+    (frame, time, drawn, [(id, x, y), ...]).
+    """
+    rows = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            tracks = zip(*(map(int, row[key].split()) for key in ('ids', 'x', 'y')))
+            # logs from before the drawn column drew the tracks on every frame
+            drawn = int(row.get('drawn', 1)) == 1
+            rows.append((int(row['frame']), float(row['time']), drawn, list(tracks)))
+    return rows
+
+
+def render(source, log_path, out_path, start_time=None, end_time=None,
+           trace_length=constants.TRACKER_TRACE_LENGTH):
+    """Draws the annotations from the overlay log onto the video (or
+    segment manifest) it was made from, and saves the result to out_path.
+
+    If start_time or end_time (in seconds, in the same times as the log)
+    are given, only that part of the video is decoded and written.
+    trace_length should be the tracker's trace length, so that the traces
+    are as long as they were while tracking.
+    """
+    rows = read_overlay_log(log_path)
+    first = next((i for i, (_, time, _, _) in enumerate(rows)
+                  if start_time is None or time >= start_time), len(rows))
+    if first == len(rows):
+        print('Nothing to render in', log_path)
+        return
+
+    cap = open_capture(source)
+    if rows[first][0] > 0:
+        cap.set(cv2.CAP_PROP_POS_MSEC, rows[first][1] * 1000)
+
+    # the tracker keeps the last trace_length+1 positions of each track
+    traces = {}
+    video_writer = None
+    for frame_number, time, drawn, tracks in rows:
+        if end_time is not None and time >= end_time:
+            break
+
+        # the traces are replayed from the start, even before start_time,
+        # so that the first rendered frame has its full traces. they only
+        # grow on the frames where the tracker ran, as while tracking
+        if drawn:
+            traces = {track_id: traces.get(track_id, collections.deque(maxlen=trace_length + 1))
+                      for track_id, _, _ in tracks}
+            for track_id, x, y in tracks:
+                traces[track_id].append((x, y))
+        if frame_number < rows[first][0]:
+            continue
+
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        if video_writer is None:
+            if not os.path.isdir(os.path.dirname(os.path.abspath(out_path))):
+                os.makedirs(os.path.dirname(os.path.abspath(out_path)))
+            height, width = frame.shape[:2]
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # codec
+            video_writer = cv2.VideoWriter(out_path, fourcc, cap.get(cv2.CAP_PROP_FPS),
+                                           (width, height))
+
+        draw_timestamp(frame, time)
+        if drawn:
+            for track_id, trace in traces.items():
+                draw_trace(frame, track_id, list(trace))
+        video_writer.write(frame)
+
+    cap.release()
+    if video_writer is not None:
+        video_writer.release()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Renders the annotated video of a tracked clip from its '
+                    'overlay log.')
+    arg_parser.add_argument('source',
+                            type=str,
+                            help='The video (or segment manifest) which was tracked.')
+    arg_parser.add_argument('log',
+                            type=str,
+                            help='The overlay log written while tracking.')
+    arg_parser.add_argument('outfile',
+                            type=str,
+                            help='The annotated video to write.')
+    arg_parser.add_argument('-s', '--start',
+                            dest='start',
+                            type=float,
+                            default=None,
+                            help='The time (in seconds) at which to start '
+                                 'rendering (default the start of the clip).')
+    arg_parser.add_argument('-e', '--end',
+                            dest='end',
+                            type=float,
+                            default=None,
+                            help='The time (in seconds) at which to stop '
+                                 'rendering (default the end of the clip).')
+    arg_parser.add_argument('-ttl', '--tracker-trace-length',
+                            dest='tracker_trace_length',
+                            type=int,
+                            default=constants.TRACKER_TRACE_LENGTH,
+                            help='The trace length the clip was tracked with '
+                                 f'(default {constants.TRACKER_TRACE_LENGTH}).')
+    args = arg_parser.parse_args()
+    render(args.source, args.log, args.outfile, args.start, args.end,
+           args.tracker_trace_length)
+
+
+if __name__ == '__main__':
+    main()
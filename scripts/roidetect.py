@@ -18,6 +18,7 @@ import argparse
 from PIL import Image
 
 import bbox
+import segment
 
 def create_aruco_coords(infile, outfile):
     """
@@ -33,7 +34,7 @@ def create_aruco_coords(infile, outfile):
         
     except IOError: 
         print("Not an image, trying as a video file")
-        video = cv2.VideoCapture(infile)
+        video = segment.SegmentCapture(infile)
         ret, frame = video.read()
         if not ret:
             raise ValueError('Frame not successfully read.')
@@ -348,7 +349,7 @@ def main():
     if not os.path.isfile(args.video):
         arg_parser.error(f'{args.video} is not a valid file.')
 
-    video = cv2.VideoCapture(args.video)
+    video = segment.SegmentCapture(args.video)
     ret, frame = video.read()
     if not ret:
         arg_parser.error('The video only has {} frames.'.format(args.frame-1))
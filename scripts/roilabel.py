@@ -6,6 +6,7 @@ import argparse
 import csv
 
 import bbox
+import segment
 
 def label_rois(
         Dict, video, roifile, outfile, draw_polys=True,
@@ -31,7 +32,7 @@ def label_rois(
         print('The video ' + video + ' was found.')
     else: 
         print('ERROR: The video ' + video + ' was not found.')
-    ret, frame = cv2.VideoCapture(video).read()
+    ret, frame = segment.SegmentCapture(video).read()
     if not ret:
         raise RuntimeError('Encountered problem reading frame from video.')
     boxes = bbox.read_bboxes(roifile)
@@ -0,0 +1,141 @@
+import argparse
+import json
+import os, os.path
+
+import cv2
+
+import metadata
+
+# Segment manifests are small json files which stand in for a video file,
+# giving the video they come from and the time range of it which they cover:
+#     {"source": "input/video.mp4", "start_time": 5.0, "end_time": 605.0}
+# Times are in seconds from the start of the source, and end_time may be
+# null to read until the end of the source. The trim and split rules can
+# write these instead of copying the video, and the scripts which read
+# their outputs seek into the source instead.
+MANIFEST_EXT = '.json'
+
+def is_manifest(path):
+    """Returns whether the given path is a segment manifest rather than a
+    video file.
+    """
+    return os.path.splitext(path)[1] == MANIFEST_EXT
+
+def write_manifest(path, source, start_time=0.0, end_time=None):
+    """Writes a segment manifest for the given range of source to path."""
+    if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+        os.makedirs(os.path.dirname(os.path.abspath(path)))
+    with open(path, 'w') as f:
+        json.dump({'source': source, 'start_time': start_time,
+                   'end_time': end_time}, f)
+
+def resolve(path):
+    """Returns a tuple (source, start_time, end_time) giving the video file
+    and time range which path refers to.
+
+    If path is a video, then it is the whole video, so this returns
+    (path, 0.0, None). Manifests which point to other manifests are
+    followed until an actual video is reached.
+    """
+    if not is_manifest(path):
+        return path, 0.0, None
+    with open(path) as f:
+        manifest = json.load(f)
+    source, start, end = resolve(manifest['source'])
+    new_start = start + manifest['start_time']
+    new_end = manifest['end_time']
+    if new_end is not None:
+        new_end += start
+        if end is not None:
+            new_end = min(new_end, end)
+    else:
+        new_end = end
+    return source, new_start, new_end
+
+def get_duration(path):
+    """Returns the duration of the given video or segment, in seconds."""
+    source, start, end = resolve(path)
+    if end is None:
+        end = metadata.get_video_duration(source)
+    return end - start
+
+def ffmpeg_input(path):
+    """Returns the ffmpeg input options which read the given video or
+    segment, seeking into the source video if it is a segment.
+    """
+    source, start, end = resolve(path)
+    options = ''
+    if start:
+        options += f'-ss {start} '
+    if end is not None:
+        options += f'-t {end - start} '
+    return options + f'-i {source}'
+
+
+class SegmentCapture:
+    """A drop-in replacement for cv2.VideoCapture which can also read
+    segment manifests. It seeks to the start of the segment, stops at the
+    end of it, and reports positions relative to the start of the segment.
+    """
+
+    def __init__(self, path):
+        self.source, self.start_time, self.end_time = resolve(path)
+        self.cap = cv2.VideoCapture(self.source)
+        if self.start_time:
+            self.cap.set(cv2.CAP_PROP_POS_MSEC, self.start_time*1000)
+
+    def read(self, image=None):
+        ret, frame = self.cap.read(image)
+        if ret and self.end_time is not None \
+                and self.cap.get(cv2.CAP_PROP_POS_MSEC) >= self.end_time*1000:
+            return False, None
+        return ret, frame
+
+    def get(self, prop):
+        value = self.cap.get(prop)
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            value -= self.start_time*1000
+        return value
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            value += self.start_time*1000
+        return self.cap.set(prop, value)
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def release(self):
+        self.cap.release()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Writes a segment manifest which trims the given video, '
+                    'instead of copying it.')
+    arg_parser.add_argument('video',
+                            type=str,
+                            help='The video (or segment manifest) to trim.')
+    arg_parser.add_argument('outfile',
+                            type=str,
+                            help='The manifest file to write.')
+    arg_parser.add_argument('-s', '--start',
+                            dest='start',
+                            type=float,
+                            default=0,
+                            help='The number of seconds to cut off of the '
+                                 'start of the video (default 0).')
+    arg_parser.add_argument('-e', '--end',
+                            dest='end',
+                            type=float,
+                            default=0,
+                            help='The number of seconds to cut off of the '
+                                 'end of the video (default 0).')
+    args = arg_parser.parse_args()
+    end_time = None
+    if args.end:
+        end_time = get_duration(args.video) - args.end
+    write_manifest(args.outfile, args.video, args.start, end_time)
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,12 @@ import json
 import os
 import os.path
 import argparse
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
 
 import constants
 import metadata
+import segment
 
 re_length = re.compile(r'Duration: (\d{2}):(\d{2}):(\d{2})\.\d+,')
 
@@ -121,6 +124,117 @@ def by_seconds(filename, destination, split_length, vcodec='copy',
                                  ).stdout.read()
 
 
+def run_cmd(cmd):
+    """Runs the given ffmpeg command and returns its output."""
+    print('About to run:', cmd, sep='')
+    return subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT).stdout.decode()
+
+def by_keyframes(filename, destination, split_length, cores=1,
+                 min_segment_length=20, **kwargs):
+    """Splits the video into segments of about split_length seconds
+    without re-encoding it.
+
+    Each segment starts on the last keyframe at or before its nominal start
+    time, and is cut by seeking to that keyframe before opening the input
+    and copying the stream, so ffmpeg never decodes the video. Up to cores
+    segments are cut in parallel.
+
+    Because the cut points snap to keyframes, the exact start and end time
+    of each segment, in seconds from the start of the input, is written to
+    segments.csv in the destination directory.
+    """
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+    if split_length <= 0:
+        print('Split length must be positive')
+        raise SystemExit
+    try:
+        packets = metadata.get_video_packets(filename)
+    except RuntimeError:
+        print("Can't read the video packets, splitting by seconds instead")
+        by_seconds(filename, destination, split_length,
+                   min_segment_length=min_segment_length)
+        return
+    times = [pts for pts, _, _ in packets]
+    keyframes = [pts for pts, keyframe, _ in packets if keyframe]
+    # the last frame lasts about as long as the one before it
+    frame_length = times[-1] - times[-2] if len(times) > 1 else 0
+    first, end = times[0], times[-1] + frame_length
+
+    starts = []
+    for n in range(math.ceil((end - first) / split_length)):
+        i = bisect_right(keyframes, first + split_length*n) - 1
+        if i >= 0 and (not starts or keyframes[i] > starts[-1]):
+            starts.append(keyframes[i])
+    if not starts:
+        starts = [first]
+    segments = list(zip(starts, starts[1:] + [end]))
+    if len(segments) > 1 and segments[-1][1] - segments[-1][0] < min_segment_length:
+        print(f'Not copying the last {segments[-1][1]-segments[-1][0]} seconds.')
+        segments.pop()
+
+    cmds = []
+    for n, (start, stop) in enumerate(segments):
+        frames = bisect_left(times, stop) - bisect_left(times, start)
+        # seek to half a frame after the keyframe, so that rounding in the
+        # printed pts can't make ffmpeg snap back to the previous keyframe
+        cmds.append(f'ffmpeg -y -loglevel warning -ss {start - first + frame_length/2:.6f} '
+                    f'-i "{filename}" -map 0:v:0 -frames:v {frames} -c copy '
+                    f'-avoid_negative_ts make_zero "{destination}{n}.mp4"')
+    if cores == 0:
+        cores = len(cmds)
+    with ProcessPoolExecutor(max_workers=cores) as executor:
+        for output in executor.map(run_cmd, cmds):
+            print(output, end='')
+
+    with open(os.path.join(destination, 'segments.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['segment', 'start_time', 'end_time'])
+        for n, (start, stop) in enumerate(segments):
+            writer.writerow([n, round(start - first, 6), round(stop - first, 6)])
+
+
+def by_seconds_virtual(filename, destination, split_length,
+                       min_segment_length=20, **kwargs):
+    """Splits the video into segments of split_length seconds, like
+    by_seconds, but writes a segment manifest for each segment instead of
+    copying the video. The later steps then seek into the original video.
+
+    filename may itself be a segment manifest (e.g. from the trim rule).
+    The start time of each segment is written to segments.csv in the
+    destination directory, as in by_keyframes.
+    """
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+    if split_length <= 0:
+        print('Split length must be positive')
+        raise SystemExit
+    try:
+        video_length = segment.get_duration(filename)
+    except RuntimeError:
+        print("Can't determine video length, using the whole video as one segment")
+        video_length = None
+    segments = []
+    if video_length is None or video_length <= split_length:
+        segments.append((0.0, video_length))
+    else:
+        for n in range(math.ceil(video_length / split_length)):
+            split_start = split_length * n
+            if video_length - split_start < min_segment_length:
+                print(f'Not keeping the last {video_length-split_start} seconds.')
+                continue
+            segments.append((split_start, min(split_start + split_length, video_length)))
+
+    with open(os.path.join(destination, 'segments.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['segment', 'start_time', 'end_time'])
+        for n, (start, stop) in enumerate(segments):
+            segment.write_manifest(f'{destination}{n}{segment.MANIFEST_EXT}',
+                                   filename, start, stop)
+            writer.writerow([n, start, stop])
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('filename',
@@ -162,6 +276,26 @@ def main():
                         help='The minimum length of a segment. If the last '
                              'segment of the video is shorter than this '
                              'length, then it is ignored. Default: 20')
+    parser.add_argument('-k', '--keyframes',
+                        dest='keyframes',
+                        action='store_true',
+                        help='Cut the segments on keyframes and copy the '
+                             'video stream instead of re-encoding it. The '
+                             'exact start time of each segment is saved to '
+                             'segments.csv in the destination.')
+    parser.add_argument('--virtual',
+                        dest='virtual',
+                        action='store_true',
+                        help='Write a segment manifest (.json) for each '
+                             'segment instead of copying the video. This is '
+                             'always done if the input is itself a manifest.')
+    parser.add_argument('-c', '--cores',
+                        dest='cores',
+                        type=int,
+                        default=1,
+                        help='The number of segments to cut in parallel '
+                             'when splitting on keyframes, default 1. If 0, '
+                             'then all segments are cut in parallel.')
     parser.add_argument('-e', '--extra',
                         dest='extra',
                         type=str,
@@ -174,6 +308,11 @@ def main():
 
     if args.filename and args.manifest:
         by_manifest(**(args.__dict__))
+    elif args.filename and args.split_length and \
+            (args.virtual or segment.is_manifest(args.filename)):
+        by_seconds_virtual(**(args.__dict__))
+    elif args.filename and args.split_length and args.keyframes:
+        by_keyframes(**(args.__dict__))
     elif args.filename and args.split_length:
         by_seconds(**(args.__dict__))
     else:
@@ -2,31 +2,31 @@ import numpy as np
 import argparse
 from track_one_clip import *
 import constants
+import framereader
+import detector
+import background
+import bbox
+import croprotate
+import detectioncache
+import maskcache
 
 
-def main():
-    arg_parser = argparse.ArgumentParser()
-    arg_parser.add_argument('source',
-                            type=str,
-                            help='The path to a video file in which we want to '
-                                 'track the ants.')
-    arg_parser.add_argument('history_path',
-                            type=str,
-                            help='The path to a directory in which to save the '
-                                 'history csv.')
-    arg_parser.add_argument('video_path',
-                            type=str,
-                            nargs='?',
-                            default=None,
-                            help='The path to a directory in which to dump'
-                                 'annotated result videos. If no path is given, then it '
-                                 'does not export videos.')
+def add_tracking_arguments(arg_parser):
+    """Adds the options which control the detector and the tracker to the
+    given argument parser. These are shared by every script which tracks ants.
+    """
     arg_parser.add_argument('-m', '--min-blob',
                             dest='min_blob',
                             type=int,
                             default=constants.MIN_BLOB,
                             help='minimum blob area in pixels (default = '
                             '%d)' % constants.MIN_BLOB)
+    arg_parser.add_argument('-xb', '--max-blob',
+                            dest='max_blob',
+                            type=int,
+                            default=constants.MAX_BLOB,
+                            help='blobs with this area (in pixels) or more are '
+                            'not ants (default = %d)' % constants.MAX_BLOB)
     arg_parser.add_argument('-c', '--count-threshold',
                             dest='count_threshold',
                             type=int,
@@ -114,6 +114,154 @@ def main():
                             default=constants.MERGE_DISTANCE,
                             help="The maximum distance allowed between two existing tracks"
                             "for it to be considered a merger.")
+    arg_parser.add_argument('-ga', '--gated-assignment',
+                            dest='gated_assignment',
+                            action='store_true',
+                            help='Assign the detections to the tracks group by group '
+                            '(the groups of tracks and detections within the distance '
+                            'threshold of each other), instead of over all of them at '
+                            'once. Much faster with many ants, but the assignments can '
+                            'differ slightly where the ants are crowded.')
+    arg_parser.add_argument('-fi', '--frame-index',
+                            dest='frame_index',
+                            action='store_true',
+                            help='Take the timestamp of each frame from the '
+                            "video's frame index (built once and saved next to "
+                            'the video), instead of from the video reader.')
+    arg_parser.add_argument('-fr', '--frame-reader',
+                            dest='frame_reader',
+                            choices=framereader.READERS,
+                            default='opencv',
+                            help="How to read frames: 'opencv' decodes to BGR "
+                            "with cv2.VideoCapture, 'ffmpeg-gray' decodes "
+                            'straight to grayscale through an ffmpeg pipe '
+                            '(default opencv)')
+    arg_parser.add_argument('-dt', '--decoder-threads',
+                            dest='decoder_threads',
+                            type=int,
+                            default=0,
+                            help='The number of threads ffmpeg decodes with, '
+                            'for the ffmpeg-gray reader. 0 lets ffmpeg decide '
+                            '(default 0)')
+    arg_parser.add_argument('-ds', '--detector-stages',
+                            dest='detector_stages',
+                            type=lambda x: x.split(','),
+                            default=constants.DETECTOR_STAGES,
+                            help='The stages the detector runs on each frame, in '
+                            'order and separated by commas, before finding the '
+                            'ants in the result. The stages are '
+                            f"{', '.join(detector.STAGES)}. Only the canny "
+                            'options affect canny, and so on (default '
+                            f"{','.join(constants.DETECTOR_STAGES)})")
+    arg_parser.add_argument('-bm', '--blob-method',
+                            dest='blob_method',
+                            choices=detector.BLOB_METHODS,
+                            default=constants.BLOB_METHOD,
+                            help="How to find the ants in the foreground mask: "
+                            "'contours' finds the outline of each blob (the "
+                            "original way), 'components' measures every blob at "
+                            'once with connected component statistics (faster, but '
+                            'the areas are pixel counts, so --min-blob and '
+                            '--max-blob need recalibrating) '
+                            f'(default {constants.BLOB_METHOD})')
+    arg_parser.add_argument('-bg', '--background-model',
+                            dest='background_model',
+                            choices=background.MODELS,
+                            default=constants.BACKGROUND_MODEL,
+                            help="The background model of the background stage: "
+                            "'knn' is OpenCV's KNN background subtractor, "
+                            "'median' is a cheaper running median (see "
+                            'background.py) '
+                            f'(default {constants.BACKGROUND_MODEL})')
+    arg_parser.add_argument('-mdt', '--median-threshold',
+                            dest='median_threshold',
+                            type=int,
+                            default=constants.MEDIAN_THRESHOLD,
+                            help='With the median background model, the '
+                            'difference in gray level from the background '
+                            'which counts as foreground '
+                            f'(default {constants.MEDIAN_THRESHOLD})')
+    arg_parser.add_argument('-mu', '--median-update-every',
+                            dest='median_update_every',
+                            type=int,
+                            default=constants.MEDIAN_UPDATE_EVERY,
+                            help='With the median background model, update '
+                            'the background once every this many frames '
+                            f'(default {constants.MEDIAN_UPDATE_EVERY})')
+    arg_parser.add_argument('-mb', '--median-batch',
+                            dest='median_batch',
+                            type=int,
+                            default=constants.MEDIAN_BATCH,
+                            help='With the median background model and '
+                            '--threaded (or track_split.py), run this many '
+                            'frames through the background model at once. '
+                            'The results are the same as one at a time, '
+                            'but with fewer calls. Not used with the motion '
+                            'gate or the illumination guard '
+                            f'(default {constants.MEDIAN_BATCH})')
+    arg_parser.add_argument('-rmp', '--roi-mask-padding',
+                            dest='roi_mask_padding',
+                            type=int,
+                            default=constants.ROI_MASK_PADDING,
+                            help="With the ROI mask, grow the ROI's polygon by "
+                            'this many pixels, so that ants leaving across its '
+                            f'edges are still followed (default {constants.ROI_MASK_PADDING})')
+    arg_parser.add_argument('-ig', '--illumination-guard',
+                            dest='illumination_guard',
+                            action='store_true',
+                            help='Watch for sudden changes of lighting (e.g. '
+                            'clouds or auto exposure), which make the whole '
+                            'frame look like foreground. On such a frame the '
+                            'background is learnt again, and no ants are '
+                            'detected until it settles.')
+    arg_parser.add_argument('-imf', '--illumination-max-foreground',
+                            dest='illumination_max_foreground',
+                            type=float,
+                            default=constants.ILLUMINATION_MAX_FOREGROUND,
+                            help='With --illumination-guard, the fraction of '
+                            'the frame which has to be foreground for the '
+                            'lighting to have changed '
+                            f'(default {constants.ILLUMINATION_MAX_FOREGROUND})')
+    arg_parser.add_argument('-imb', '--illumination-max-blobs',
+                            dest='illumination_max_blobs',
+                            type=int,
+                            default=constants.ILLUMINATION_MAX_BLOBS,
+                            help='With --illumination-guard, the most ants '
+                            'which can be found on a frame before it is '
+                            f'treated as a change (default {constants.ILLUMINATION_MAX_BLOBS})')
+    arg_parser.add_argument('-ih', '--illumination-hold',
+                            dest='illumination_hold',
+                            type=int,
+                            default=constants.ILLUMINATION_HOLD,
+                            help='With --illumination-guard, the number of '
+                            'frames after a change on which no ants are '
+                            f'detected (default {constants.ILLUMINATION_HOLD})')
+    arg_parser.add_argument('-th', '--threaded',
+                            dest='threaded',
+                            action='store_true',
+                            help='Decode, detect, track and write the annotated '
+                            'video in separate threads at the same time. The '
+                            'results are the same as without it.')
+    arg_parser.add_argument('-mg', '--motion-gate',
+                            dest='motion_gate',
+                            action='store_true',
+                            help='Skip detection and tracking on frames with '
+                            'no motion since the last processed frame, while '
+                            'no ants are being tracked.')
+    arg_parser.add_argument('-mt', '--motion-threshold',
+                            dest='motion_threshold',
+                            type=int,
+                            default=constants.MOTION_THRESHOLD,
+                            help='With --motion-gate, the change in gray level '
+                            '(of a 4x4 block) which counts as motion '
+                            f'(default {constants.MOTION_THRESHOLD})')
+    arg_parser.add_argument('-be', '--background-every',
+                            dest='background_every',
+                            type=int,
+                            default=constants.BACKGROUND_EVERY,
+                            help='With --motion-gate, update the background '
+                            'model on every nth skipped frame '
+                            f'(default {constants.BACKGROUND_EVERY})')
     arg_parser.add_argument('-au', '--auto',
                             dest='automatic',
                             action='store_const',
@@ -128,6 +276,115 @@ def main():
                             default=False,
                             help='Create a video player and display the tracking '
                             'mask. Useful for debugging.')
+    return arg_parser
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('source',
+                            type=str,
+                            help='The path to a video file in which we want to '
+                                 'track the ants (or, with --replay, a detection '
+                                 'cache, or with --from-masks, a mask cache).')
+    arg_parser.add_argument('history_path',
+                            type=str,
+                            help='The path to a directory in which to save the '
+                                 'history csv.')
+    arg_parser.add_argument('video_path',
+                            type=str,
+                            nargs='?',
+                            default=None,
+                            help='The path to a directory in which to dump'
+                                 'annotated result videos. If no path is given, then it '
+                                 'does not export videos.')
+    arg_parser.add_argument('-ol', '--overlay-log',
+                            dest='overlay_log',
+                            type=str,
+                            default=None,
+                            help='The path at which to save the overlay log: the '
+                                 'timestamp and track positions of every frame, from '
+                                 'which overlay.py can render the annotated video later. '
+                                 'Usually given instead of video_path, which is much slower.')
+    arg_parser.add_argument('-rm', '--roi-mask',
+                            dest='roi_mask',
+                            type=str,
+                            default=None,
+                            help='The file of ROIs which the source was cropped '
+                                 'from. If given, ants are only detected inside '
+                                 "the ROI's polygon, instead of in the whole "
+                                 'rectangle around it.')
+    arg_parser.add_argument('-rn', '--roi-name',
+                            dest='roi_name',
+                            type=int,
+                            default=None,
+                            help='With --roi-mask, the name of the ROI (as in '
+                                 'ROI_<name>.mp4) which the source is. By default '
+                                 "it is taken from the source's file name.")
+    arg_parser.add_argument('-dc', '--detection-cache',
+                            dest='detection_cache',
+                            type=str,
+                            default=None,
+                            help='The path at which to save the detections of '
+                                 'every frame (a %s file), from which the clip can '
+                                 'be tracked again with --replay.' % detectioncache.CACHE_EXT)
+    arg_parser.add_argument('-rp', '--replay',
+                            dest='replay',
+                            action='store_true',
+                            help='The source is a detection cache (saved with '
+                                 '--detection-cache) rather than a video. Only the '
+                                 'tracker is run, with the tracker options given, '
+                                 'so the detector options are ignored and no '
+                                 'annotated video is made.')
+    arg_parser.add_argument('-fm', '--foreground-masks',
+                            dest='foreground_masks',
+                            type=str,
+                            default=None,
+                            help='The path at which to save the foreground mask '
+                                 'of every frame (a %s file), from which the clip '
+                                 'can be detected and tracked again with '
+                                 '--from-masks.' % maskcache.MASK_EXT)
+    arg_parser.add_argument('-frm', '--from-masks',
+                            dest='from_masks',
+                            action='store_true',
+                            help='The source is a mask cache (saved with '
+                                 '--foreground-masks) rather than a video. The '
+                                 'detector stages after the background, and the '
+                                 'tracker, are run with the options given, '
+                                 'without learning the background again. No '
+                                 'annotated video is made.')
+    arg_parser.add_argument('-ev', '--events-path',
+                            dest='events_path',
+                            type=str,
+                            default=None,
+                            help='With --illumination-guard, the path at which '
+                                 'to save the sudden changes of lighting (a csv).')
+    arg_parser.add_argument('-bi', '--background-in',
+                            dest='background_in',
+                            type=str,
+                            default=None,
+                            help='The background of this ROI at the end of the '
+                                 'previous split (saved with --background-out), to '
+                                 'start from instead of learning the background '
+                                 'from scratch.')
+    arg_parser.add_argument('-bo', '--background-out',
+                            dest='background_out',
+                            type=str,
+                            default=None,
+                            help='Where to save the background (a png) at the end '
+                                 'of this clip, for the next split to start from.')
+    arg_parser.add_argument('-dfm', '--defer-merges',
+                            dest='defer_merges',
+                            action='store_true',
+                            help='Only list the merge clips in merger/.../merges.json, '
+                                 'instead of cutting them. They can be cut later, when '
+                                 'someone wants to look at them, with mergeclips.py.')
+    arg_parser.add_argument('-mc', '--merge-cores',
+                            dest='merge_cores',
+                            type=int,
+                            default=1,
+                            help='The number of merge clips to cut at the same time '
+                                 '(default 1).')
+    add_tracking_arguments(arg_parser)
     args = arg_parser.parse_args()
 
     print('Tracking ants in', args.source)
@@ -137,14 +394,64 @@ def main():
     if args.video_path == None:
         args.video_path = ''
 
+    roi_mask = None
+    if args.roi_mask:
+        if args.roi_name is None:
+            args.roi_name = int(os.path.splitext(os.path.basename(args.source))[0].split('_')[-1])
+        index = {name: i for i, name in croprotate.ROI_NAMES.items()}[args.roi_name]
+        roi_mask = bbox.read_bboxes(args.roi_mask)[index].crop_mask(args.roi_mask_padding)
+
     print(args.history_path)
-    tracker_object = trackOneClip(args.source, args.video_path, export,
-                 args.min_blob, args.gaussians,
-                 args.canny_threshold_one, args.canny_threshold_two,
-                 args.canny_aperture_size, args.thresholding_threshold, 
-                 args.dilating_matrix, args.tracker_distance_threshold,
-                 args.tracker_trace_length, args.no_ant_counter_frames_total,
-                 args.edge_border, args.merge_distance)
+    if args.replay:
+        tracker_object = replayClip(args.source, args.tracker_distance_threshold,
+                                    args.tracker_trace_length, args.no_ant_counter_frames_total,
+                                    args.edge_border, args.merge_distance,
+                                    gated_assignment=args.gated_assignment)
+        # the merge clips are cut from the video the detections were made from
+        args.source = detectioncache.DetectionCache(args.source).source
+        args.video_path = args.overlay_log = None
+    elif args.from_masks:
+        tracker_object = detectMasks(args.source, args.min_blob, args.gaussians,
+                                     args.canny_threshold_one, args.canny_threshold_two,
+                                     args.canny_aperture_size, args.thresholding_threshold,
+                                     args.dilating_matrix, args.tracker_distance_threshold,
+                                     args.tracker_trace_length, args.no_ant_counter_frames_total,
+                                     args.edge_border, args.merge_distance,
+                                     blob_method=args.blob_method,
+                                     detector_stages=args.detector_stages,
+                                     max_blob=args.max_blob, roi_mask=roi_mask,
+                                     illumination_guard=args.illumination_guard,
+                                     illumination_max_foreground=args.illumination_max_foreground,
+                                     illumination_max_blobs=args.illumination_max_blobs,
+                                     illumination_hold=args.illumination_hold,
+                                     gated_assignment=args.gated_assignment)
+        args.source = maskcache.MaskCache(args.source).source
+        args.video_path = args.overlay_log = None
+    else:
+        tracker_object = trackOneClip(args.source, args.video_path, export,
+                     args.min_blob, args.gaussians,
+                     args.canny_threshold_one, args.canny_threshold_two,
+                     args.canny_aperture_size, args.thresholding_threshold, 
+                     args.dilating_matrix, args.tracker_distance_threshold,
+                     args.tracker_trace_length, args.no_ant_counter_frames_total,
+                     args.edge_border, args.merge_distance,
+                     frame_index=args.frame_index, frame_reader=args.frame_reader,
+                     decoder_threads=args.decoder_threads, threaded=args.threaded,
+                     motion_gate=args.motion_gate, motion_threshold=args.motion_threshold,
+                     background_every=args.background_every, overlay_path=args.overlay_log,
+                     blob_method=args.blob_method, debug=args.debug,
+                     detector_stages=args.detector_stages,
+                     background_model=args.background_model,
+                     median_threshold=args.median_threshold,
+                     median_update_every=args.median_update_every,
+                     median_batch=args.median_batch,
+                     background_in=args.background_in, background_out=args.background_out,
+                     roi_mask=roi_mask, illumination_guard=args.illumination_guard,
+                     illumination_max_foreground=args.illumination_max_foreground,
+                     illumination_max_blobs=args.illumination_max_blobs,
+                     illumination_hold=args.illumination_hold, events_path=args.events_path,
+                     detections_path=args.detection_cache, max_blob=args.max_blob,
+                     masks_path=args.foreground_masks, gated_assignment=args.gated_assignment)
 
     # makes the history csvs
     final_result_path_history = make_history_CSV(tracker_object, args.history_path)
@@ -162,7 +469,11 @@ def main():
     merger_annotated_dir = os.path.join(os.path.join(os.path.join(os.path.join(intermediate, "merger_annotated"), video), split), roi)
 
     # makes the merge videos
-    make_merge_vids(final_result_path_history, args.source, args.video_path, merger_dir, merger_annotated_dir)
+    # the annotated merge videos are cut from the annotated video if there is one, and
+    # otherwise rendered from the overlay log
+    annotated_source = args.video_path or args.overlay_log
+    make_merge_vids(final_result_path_history, args.source, annotated_source, merger_dir, merger_annotated_dir,
+                    args.tracker_trace_length, args.merge_cores, args.defer_merges)
 
 
 if __name__ == '__main__':
@@ -2,13 +2,21 @@
 # https://github.com/srianant/kalman_filter_multi_object_tracking
 
 import cv2
-from detector import Detector, display
+from detector import Detector, MotionGate, IlluminationGuard, display, load_background
 from tracker import Tracker
-import tracker
+from framereader import open_capture
+import frameindex
+import overlay
+import mergeclips
+import detectioncache
+import maskcache
+from overlay import draw_timestamp, draw_trace
+import constants
 import collections
+import queue
+import threading
 import csv
 import os
-from math import floor, ceil
 
 
 def trackOneClip(
@@ -16,34 +24,59 @@ def trackOneClip(
         canny_threshold_one, canny_threshold_two, canny_aperture_size,
         thresholding_threshold, dilating_matrix, tracker_distance_threshold,
         tracker_trace_length, no_ant_counter_frames_total, edge_border, 
-        merge_distance):
+        merge_distance, frame_index=False, frame_reader='opencv', decoder_threads=0,
+        threaded=False, motion_gate=False, motion_threshold=constants.MOTION_THRESHOLD,
+        background_every=constants.BACKGROUND_EVERY, overlay_path=None,
+        blob_method=constants.BLOB_METHOD, debug=False, detector_stages=constants.DETECTOR_STAGES,
+        background_model=constants.BACKGROUND_MODEL, median_threshold=constants.MEDIAN_THRESHOLD,
+        median_update_every=constants.MEDIAN_UPDATE_EVERY, median_batch=constants.MEDIAN_BATCH,
+        background_in=None, background_out=None, roi_mask=None, illumination_guard=False,
+        illumination_max_foreground=constants.ILLUMINATION_MAX_FOREGROUND,
+        illumination_max_blobs=constants.ILLUMINATION_MAX_BLOBS,
+        illumination_hold=constants.ILLUMINATION_HOLD, events_path=None, detections_path=None,
+        max_blob=constants.MAX_BLOB, masks_path=None, gated_assignment=False):
     
-    cap = cv2.VideoCapture(source)  # create video reader object
-
-    # we use these variables in different python files, hence we make it global
-    global width, height, fps, frame_counter, x_bound_left, x_bound_right, y_bound_bottom, y_bound_top
+    # create video reader object (source may be a segment manifest). see framereader.py
+    cap = open_capture(source, frame_reader, decoder_threads)
 
     # get width, height, and frames per second of video
     width, height, fps = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), cap.get(cv2.CAP_PROP_FPS)
     size = (width, height)
 
+    # roi_mask is the mask of the ROI's polygon (see BBox.crop_mask), if only the pixels inside it are wanted
+    if roi_mask is not None and roi_mask.shape != (height, width):
+        print(f'WARNING: the ROI mask is {roi_mask.shape[1]}x{roi_mask.shape[0]} but {source} is '
+              f'{width}x{height}, so it is not used')
+        roi_mask = None
+
     # create detector object
-    detector_object = Detector(minBlob, num_gaussians, canny_threshold_one, canny_threshold_two, canny_aperture_size, thresholding_threshold, dilating_matrix)
+    detector_object = Detector(minBlob, num_gaussians, canny_threshold_one, canny_threshold_two, canny_aperture_size, thresholding_threshold, dilating_matrix,
+                               blob_method, debug, detector_stages,
+                               background_model, median_threshold, median_update_every, roi_mask,
+                               max_blob)
+
+    # start from the background saved at the end of the previous split, if given (see detector.py)
+    if background_in:
+        detector_object.warm_start(load_background(background_in), (height, width))
 
     # create tracker object
-    tracker_object = Tracker(tracker_distance_threshold, tracker_trace_length, merge_distance)
+    tracker_object = Tracker(tracker_distance_threshold, tracker_trace_length, merge_distance, fps,
+                             gated_assignment)
+
+    # if motion_gate is set, idle frames skip detection and tracking (see MotionGate in detector.py)
+    gate = MotionGate(motion_threshold, background_every) if motion_gate else None
+
+    # if illumination_guard is set, sudden changes of the whole frame reset the background
+    # instead of making tracks out of the noise (see IlluminationGuard in detector.py)
+    guard = IlluminationGuard(illumination_max_foreground, illumination_max_blobs,
+                              illumination_hold) if illumination_guard else None
 
     frame_counter = 0  # counts number of frames have been read by video reader
 
     # gets coordinates of borders of videos (this value is set by edge_border)
     x_bound_left, x_bound_right = edge_border, width - edge_border
     y_bound_bottom, y_bound_top = edge_border, height - edge_border
-
-    # each track gets displayed in a different color (avoids confusion)
-    # remember we use bgr not rgb
-    track_colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0),
-                    (0, 255, 255), (255, 0, 255), (255, 127, 255),
-                    (127, 0, 255), (127, 0, 127)]
+    bounds = (x_bound_left, x_bound_right, y_bound_bottom, y_bound_top)
 
     # used for debugging (local use only)
     pause = False
@@ -53,170 +86,93 @@ def trackOneClip(
         fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # codec
         video_writer_full = cv2.VideoWriter(vidPath, fourcc, fps, size)
 
+    # if overlay_path is given, instead of (or as well as) drawing the annotations, we log what
+    # would be drawn on each frame, so the annotated video can be rendered later (see overlay.py)
+    overlay_log = overlay.OverlayLog(overlay_path) if overlay_path else None
+
+    # if detections_path is given, the detections of every frame are saved there, so the clip
+    # can be tracked again with other tracker settings without detecting anything (see replayClip)
+    detection_writer = detectioncache.DetectionWriter(detections_path, source, fps, width, height) \
+        if detections_path else None
+
+    # if masks_path is given, the foreground mask of every frame is saved there, so the rest of the
+    # detector can be run again with other settings without learning the background (see detectMasks)
+    mask_writer = maskcache.MaskWriter(masks_path, source, fps, width, height) if masks_path else None
+
 
     # current timestamp returns the time passed in the video.
     # weirdly, doing frame_counter / fps doesn't give us the same answer as current timestamp
     # so just use current timestamp for consistency sake
-    global current_timestamp
     current_timestamp = 0.0
 
 
-    # don't touch first_go. without it, you might get exit times that are less than
-    # entry times (due to how the current pipeline works)
-    first_go = False
+    # if frame_index is set, the timestamps come from the pts of each frame in the
+    # video's frame index (see frameindex.py), instead of asking the video reader
+    clock = FrameClock(cap, load_timestamps(source) if frame_index else [])
+
+    # if threaded, decoding, detection, tracking and writing run at the same time
+    # in separate threads. this gives exactly the same results as the loop below
+    if threaded:
+        track_frames_threaded(cap, clock, detector_object, tracker_object, source,
+                              no_ant_counter_frames_total, bounds,
+                              video_writer_full if vidExport else None, gate, overlay_log, guard,
+                              detection_writer, mask_writer, median_batch)
+        cap.release()
+        if vidExport:
+            video_writer_full.release()
+        if overlay_log is not None:
+            overlay_log.close()
+        if detection_writer is not None:
+            detection_writer.close()
+        if mask_writer is not None:
+            mask_writer.close()
+        if gate is not None:
+            gate.report(source)
+        if guard is not None:
+            guard.report(source)
+            if events_path:
+                make_events_CSV(guard.events, events_path)
+        detector_object.report_timing(source)
+        if background_out:
+            detector_object.save_background(background_out)
+        return tracker_object
     
     while (True):
         ret, frame = cap.read()  # read one frame
         if not ret:
             break  # frame is invalid or we are done with entire video
 
-        # this avoids weird negative times
-        temp_timestamp = round(cap.get(cv2.CAP_PROP_POS_MSEC) / 1000, 2)
-        if temp_timestamp == 0 and not first_go:
-            first_go = True
-            current_timestamp = temp_timestamp
-        elif temp_timestamp == 0 and first_go:
-            pass
-        else:
-            current_timestamp = temp_timestamp
+        current_timestamp = clock.tick(frame_counter)
 
 
-        # returns ant centers and ant areas in frame (if detected)
-        centers, areas = detector_object.Detect(frame)  # each ant
+        # returns ant centers and ant areas in frame (if detected), or None if the frame was skipped
+        detections = gated_detect(gate, detector_object, tracker_object, frame,
+                                  guard, frame_counter, current_timestamp, mask_writer)
+        centers, areas = detections if detections is not None else ([], [])
+        if detection_writer is not None:
+            detection_writer.log(current_timestamp, detections)
 
-        # put timestamp on video
-        cv2.putText(frame, str(current_timestamp), (0, 10), cv2.FONT_HERSHEY_SIMPLEX, .4, (0, 255, 0), 2)
+        # the annotations are in colour, so grayscale frames are converted back
+        if vidExport and frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
 
-        # checks if ant has left the frame
-        for i in range(len(tracker_object.tracks)):
-            try:
-                track_id = tracker_object.tracks[i].track_id
-
-                # checks if ant is seen on the frame at the moment.
-                # note this might trigger if an ant has "blipped" out of existence for one frame.
-                if frame_counter - tracker_object.tracks[i].frame_last_seen > 0:
-                    tracker_object.tracks[i].exists_on_frame = False
+        # put timestamp on video
+        if vidExport:
+            draw_timestamp(frame, current_timestamp)
 
-                place_last_seen = tuple(int(value[0]) for value in tracker_object.tracks[i].trace[-1])
+        if detections is not None:
+            track_detections(tracker_object, centers, areas, source,
+                             no_ant_counter_frames_total, bounds, frame_counter, current_timestamp)
 
-                # if the ant disappeared near the edge, we will give it no_ant_counter_frames_total number of frames 
-                # to reappear. otherwise, it will be considered gone and the active track will be deleted (it will
-                # still remain in the history)
-                if x_bound_left <= place_last_seen[0] <= x_bound_right and y_bound_bottom <= place_last_seen[1] <= y_bound_top:  # by the border
-                    gone_frames = no_ant_counter_frames_total * 1  # change scalar
-
-                # if the ant disappeared in the middle, we will be more generous and give it no_ant_counter_frames_total
-                # times 2 frames to reappear. otherwise it will be considered gone and will be flagged as "end_middle"
-                # PLEASE FEEL FREE TO CHANGE THE SCALAR --> IT DOESN'T HAVE TO BE * 2
-                else:  # disappeared in the middle:
-                    gone_frames = no_ant_counter_frames_total * 2  # change scalar
-                    
-                # the ant hasn't been seen in awhile, so we will now delete its corresponding active track
-                if frame_counter - tracker_object.tracks[i].frame_last_seen > gone_frames:
-                    time_last_seen = round(current_timestamp - gone_frames / fps, 2)
-                    place_last_seen = tuple(int(value[0]) for value in tracker_object.tracks[i].trace[-1])
-                    
-                    print(f"Ant {track_id} last seen {place_last_seen} at time {time_last_seen}")
-
-                    tracker_object.tracks[i].x1 = place_last_seen[0]
-                    tracker_object.tracks[i].y1 = place_last_seen[1]
-                    tracker_object.tracks[i].t1 = time_last_seen
-
-                    # if the ant disappeared within the borders of the frame dictated by edge_border
-                    if x_bound_left <= place_last_seen[0] <= x_bound_right and y_bound_bottom <= place_last_seen[1] <= y_bound_top:
-                        print(f"WARNING: Ant {track_id} disappeared in the middle")
-
-                        tracker_object.tracks[i].appear_middle_end = True  # this will flag "end_middle" as true
-
-
-                    # it is possible an ant leaves while merged with another ant
-                    # we will assume the ants eventually unmerged, so the new unmerge time will be the time
-                    # the ant was last seen
-                    if tracker_object.tracks[i].attached_to_me > 0:
-                        print(f"Merged ant {tracker_object.tracks[i].track_id} left. There was no unmerger")
-                        tracker_object.tracks[i].unmerge_time.append(time_last_seen)
-
-
-                    # we want to copy this information to its corresponding history
-                    # remember every active track has its corresponding history object. 
-                    # the active track's id is the SAME as the index of the histories list. 
-                    Tracker.copy_track_to_history(tracker_object.histories[track_id], tracker_object.tracks[i])
-
-                    # delete now obselete active track
-                    print(f"Removed ant {tracker_object.tracks[i].track_id} from active tracks list\n")
-                    del tracker_object.tracks[i]
-                    del tracker.assignment[i]
-            except:
-                pass
+        if overlay_log is not None:
+            overlay_log.log(frame_counter, current_timestamp, tracker_object, len(centers) > 0)
 
         # if ants were detected on frame
         if len(centers) > 0:
 
-            # make new updated predictions with given coordinates
-            tracker_object.Update(centers, areas)
-
-            # when ants are detected for the first time (they entered the frame for the first time)
-            for i in range(len(tracker_object.tracks)):
-                # first_shoutout checks if initial information was already gathered
-                # if it has, don't gather it again (as it will override the correct information)
-                if tracker_object.tracks[i].first_shoutout:
-                    continue
-                else:
-                    time_first_seen = current_timestamp
-
-                    start = os.path.abspath(__file__)   # relative path of source
-                    relative_path = os.path.relpath(source, start)
-
-                    track_id = tracker_object.tracks[i].track_id
-                    
-                    # IMPORTANT: the place_first seen is actually NOT set to trace[0]. this is because the tracker
-                    # sets the initial position quite far away from the actual ant, and takes around 2 frames
-                    # for the tracker to properly adjust the position
-                    # We set all info for trace[0] and trace[1] in case the trace never gets that long, and then
-                    # when we get to trace[2] we call that the first time the ant was seen (set first_shoutout)
-
-                    if len(tracker_object.tracks[i].trace) == 0:
-                        place_first_seen = (-1,-1)
-                    else:
-                        place_first_seen = tuple(int(value[0]) for value in tracker_object.tracks[i].trace[-1])
-                    if len(tracker_object.tracks[i].trace) == 3:
-                        print(f"Ant {track_id} first seen: {place_first_seen} at time {time_first_seen}")
-                        tracker_object.tracks[i].first_shoutout = True
-
-                    # detects if the ant appeared in the middle (threshold determined by edge_border)
-                    if x_bound_left <= place_first_seen[0] <= x_bound_right and y_bound_bottom <= place_first_seen[1] <= y_bound_top:
-                        print(f"WARNING: Ant {track_id} appeared in the middle")
-                        tracker_object.tracks[i].appear_middle_begin = True
-
-                    # store relevant information
-                    tracker_object.tracks[i].filename = relative_path
-                    tracker_object.tracks[i].x0 = place_first_seen[0]
-                    tracker_object.tracks[i].y0 = place_first_seen[1]
-                    tracker_object.tracks[i].t0 = time_first_seen
-
-                    # copy active track information to corresponding history object
-                    Tracker.copy_track_to_history(tracker_object.histories[track_id], tracker_object.tracks[i])
-
             # we draw the id on top of the ant as well as the trace
             if vidExport:
-                for i in range(len(tracker_object.tracks)):
-                    if (len(tracker_object.tracks[i].trace) > 1):
-                        for j in range(len(tracker_object.tracks[i].trace)-1):
-                            # trace line
-                            x1_trace = tracker_object.tracks[i].trace[j][0][0]
-                            y1_trace = tracker_object.tracks[i].trace[j][1][0]
-                            x2 = tracker_object.tracks[i].trace[j+1][0][0]
-                            y2 = tracker_object.tracks[i].trace[j+1][1][0]
-                            clr = tracker_object.tracks[i].track_id % 9
-                            cv2.line(frame, (int(x1_trace), int(y1_trace)), (int(x2), int(y2)),
-                                        track_colors[clr], 1)
-
-                            text = tracker_object.tracks[i].track_id  # track_id
-                            # text = tuple(int(value[0]) for value in tracker_object.tracks[i].trace[-1])  # coordinates
-                            # text = tracker_object.tracks[i].area  # area
-                            
-                            cv2.putText(frame, str(text), (int(x2), int(
-                                y2)), cv2.FONT_HERSHEY_SIMPLEX, .5, track_colors[clr], 1, cv2.LINE_AA)
+                draw_tracks(frame, tracker_object)
 
                 # this won't work on the server, as there is no display corresponding to the server
                 # you will need to "connect" your display with the server (you will have to look this up)
@@ -240,18 +196,402 @@ def trackOneClip(
                                 break
         
         frame_counter += 1  # an advancement of a frame
-        video_writer_full.write(frame)  # save frame into video writer
+        if vidExport:
+            video_writer_full.write(frame)  # save frame into video writer
 
 
     cap.release()  # releases video reader
     cv2.destroyAllWindows() 
     if vidExport:
         video_writer_full.release()  # saves contents of video writer
-
+    if overlay_log is not None:
+        overlay_log.close()
+    if detection_writer is not None:
+        detection_writer.close()
+    if mask_writer is not None:
+        mask_writer.close()
+    if gate is not None:
+        gate.report(source)  # the fraction of frames which were skipped
+    if guard is not None:
+        guard.report(source)  # the number of sudden changes of lighting
+        if events_path:
+            make_events_CSV(guard.events, events_path)
+    detector_object.report_timing(source)  # the time spent in each stage of the detector
+    if background_out:
+        detector_object.save_background(background_out)  # for the next split to start from
 
     return tracker_object  # tracker_object contains histories
 
 
+# tracks the ants again from the detections saved in a detection cache (see detectioncache.py),
+# without decoding the video or detecting anything, so that the tracker settings can be changed
+# without redoing the (slow) detection. each frame gets the same timestamp and detections as when
+# the cache was made, so the results are the same as tracking the video with these settings
+def replayClip(cache_path, tracker_distance_threshold, tracker_trace_length,
+               no_ant_counter_frames_total, edge_border, merge_distance, gated_assignment=False):
+    cache = detectioncache.DetectionCache(cache_path)
+    fps = cache.fps
+    bounds = (edge_border, cache.width - edge_border, edge_border, cache.height - edge_border)
+    tracker_object = Tracker(tracker_distance_threshold, tracker_trace_length, merge_distance, fps,
+                             gated_assignment)
+
+    for frame_counter, current_timestamp, detections in cache.frames():
+        if detections is not None:
+            centers, areas = detections
+            track_detections(tracker_object, centers, areas, cache.source,
+                             no_ant_counter_frames_total, bounds, frame_counter, current_timestamp)
+
+    return tracker_object
+
+
+# detects and tracks the ants again from the foreground masks saved in a mask cache (see
+# maskcache.py), running only the stages of the detector after the background stage (which has to
+# come first), and the tracker. the video isn't decoded and the background isn't learnt, so this is
+# much quicker than trackOneClip for trying out other detector (and tracker) settings
+def detectMasks(
+        cache_path, minBlob, num_gaussians,
+        canny_threshold_one, canny_threshold_two, canny_aperture_size,
+        thresholding_threshold, dilating_matrix, tracker_distance_threshold,
+        tracker_trace_length, no_ant_counter_frames_total, edge_border,
+        merge_distance, blob_method=constants.BLOB_METHOD,
+        detector_stages=constants.DETECTOR_STAGES, max_blob=constants.MAX_BLOB, roi_mask=None,
+        illumination_guard=False, illumination_max_foreground=constants.ILLUMINATION_MAX_FOREGROUND,
+        illumination_max_blobs=constants.ILLUMINATION_MAX_BLOBS,
+        illumination_hold=constants.ILLUMINATION_HOLD, gated_assignment=False):
+    if not detector_stages or detector_stages[0] != 'background':
+        raise ValueError('Detecting from saved masks needs background to be the first detector stage')
+
+    cache = maskcache.MaskCache(cache_path)
+    fps = cache.fps
+    bounds = (edge_border, cache.width - edge_border, edge_border, cache.height - edge_border)
+    detector_object = Detector(minBlob, num_gaussians, canny_threshold_one, canny_threshold_two, canny_aperture_size, thresholding_threshold, dilating_matrix,
+                               blob_method, stages=detector_stages[1:], mask=roi_mask, max_blob=max_blob)
+    tracker_object = Tracker(tracker_distance_threshold, tracker_trace_length, merge_distance, fps,
+                             gated_assignment)
+    guard = IlluminationGuard(illumination_max_foreground, illumination_max_blobs,
+                              illumination_hold) if illumination_guard else None
+
+    for frame_counter, current_timestamp, mask in cache.frames():
+        if mask is None:
+            continue  # the frame wasn't detected or tracked when the masks were saved
+        centers, areas = gated_detect(None, detector_object, tracker_object, mask, guard,
+                                      frame_counter, current_timestamp)
+        track_detections(tracker_object, centers, areas, cache.source,
+                         no_ant_counter_frames_total, bounds, frame_counter, current_timestamp)
+
+    return tracker_object
+
+
+# works out the timestamp of each frame, either from the frame index (if given) or
+# from the video reader
+class FrameClock:
+    def __init__(self, cap, timestamps=()):
+        self.cap = cap
+        self.timestamps = timestamps
+        self.current_timestamp = 0.0
+
+        # don't touch first_go. without it, you might get exit times that are less than
+        # entry times (due to how the current pipeline works)
+        self.first_go = False
+
+    # returns the timestamp of the frame which was just read, which is frame number frame_counter
+    def tick(self, frame_counter):
+        if frame_counter < len(self.timestamps):
+            self.current_timestamp = round(float(self.timestamps[frame_counter]), 2)
+        else:
+            # this avoids weird negative times
+            temp_timestamp = round(self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000, 2)
+            if temp_timestamp == 0 and not self.first_go:
+                self.first_go = True
+                self.current_timestamp = temp_timestamp
+            elif temp_timestamp == 0 and self.first_go:
+                pass
+            else:
+                self.current_timestamp = temp_timestamp
+        return self.current_timestamp
+
+
+# the number of frames each stage of track_frames_threaded can get ahead of the next one
+QUEUE_SIZE = 8
+
+
+# runs the same per-frame work as the loop in trackOneClip, but as four stages (decode, detect,
+# track, write) in their own threads, connected by bounded queues. OpenCV releases the GIL while
+# decoding, subtracting the background, finding contours and encoding, so the stages overlap.
+# each stage handles the frames one at a time and in order, so the results are the same as the
+# serial loop. a full queue makes the stage before it wait (so memory use is bounded), and frame
+# buffers are handed back to the decoder once written, so they are reused instead of reallocated.
+# the frames are passed from the decoder to the detector in batches of up to batch frames, which
+# go through the background model together if it takes batches (see Detector.background_batch)
+def track_frames_threaded(cap, clock, detector_object, tracker_object, source,
+                          no_ant_counter_frames_total, bounds, video_writer, gate=None,
+                          overlay_log=None, guard=None, detection_writer=None, mask_writer=None,
+                          batch=1):
+    # the gate decides frame by frame whether to run the background model, and the guard can
+    # reset it after any frame, so with either of them the frames go through it one at a time
+    if gate is not None or guard is not None or not detector_object.can_batch():
+        batch = 1
+    detect_queue = queue.Queue(QUEUE_SIZE)
+    track_queue = queue.Queue(QUEUE_SIZE)
+    write_queue = queue.Queue(QUEUE_SIZE)
+    free_buffers = queue.Queue()
+    errors = []
+
+    def decode():
+        frame_number = 0
+        items = []
+        while not errors:
+            try:
+                buffer = free_buffers.get_nowait()
+            except queue.Empty:
+                buffer = None
+            if buffer is None:
+                ret, frame = cap.read()
+                # some readers reuse one buffer for every frame, so keep our own copy
+                frame = frame.copy() if ret else frame
+            else:
+                ret, frame = cap.read(buffer)
+            if not ret:
+                break
+            items.append((frame, clock.tick(frame_number), frame_number))
+            frame_number += 1
+            if len(items) == batch:
+                detect_queue.put(items)
+                items = []
+        if items:
+            detect_queue.put(items)
+
+    # whether the motion gate skips a frame depends on whether any ants are being tracked,
+    # so with the gate, detection has to wait for the track stage and is done there
+    def detect(items):
+        foregrounds = [None] * len(items)
+        if batch > 1:
+            foregrounds = detector_object.background_batch([frame for frame, _, _ in items])
+        for (frame, timestamp, frame_number), foreground in zip(items, foregrounds):
+            detections = gated_detect(None, detector_object, tracker_object, frame, guard,
+                                      frame_number, timestamp, mask_writer,
+                                      foreground) if gate is None else None  # each ant
+            track_queue.put((frame, timestamp, frame_number, detections))
+
+    def track(item):
+        frame, current_timestamp, frame_counter, detections = item
+        if gate is not None:
+            detections = gated_detect(gate, detector_object, tracker_object, frame,
+                                      guard, frame_counter, current_timestamp, mask_writer)
+        centers, areas = detections if detections is not None else ([], [])
+        if detection_writer is not None:
+            detection_writer.log(current_timestamp, detections)
+        annotated = frame
+        if video_writer is not None:
+            # the annotations are in colour, so grayscale frames are converted back
+            if frame.ndim == 2:
+                annotated = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+            draw_timestamp(annotated, current_timestamp)
+        if detections is not None:
+            track_detections(tracker_object, centers, areas, source,
+                             no_ant_counter_frames_total, bounds, frame_counter, current_timestamp)
+        if overlay_log is not None:
+            overlay_log.log(frame_counter, current_timestamp, tracker_object, len(centers) > 0)
+        if len(centers) > 0 and video_writer is not None:
+            draw_tracks(annotated, tracker_object)
+        write_queue.put((frame, annotated))
+
+    def write(item):
+        frame, annotated = item
+        try:
+            if video_writer is not None:
+                video_writer.write(annotated)  # save frame into video writer
+        finally:
+            free_buffers.put(frame)  # the decoder can now reuse this buffer
+
+    # runs one stage, and once the stage before it is done, tells the next one it is done.
+    # if any stage fails, the rest stop working but keep emptying their queues, so
+    # nothing is left waiting on a full queue
+    def run_stage(work, inbox, outbox):
+        try:
+            if inbox is None:
+                work()
+            else:
+                for item in iter(inbox.get, None):
+                    if not errors:
+                        work(item)
+        except BaseException as e:
+            errors.append(e)
+            if inbox is not None:
+                for item in iter(inbox.get, None):
+                    pass
+        finally:
+            if outbox is not None:
+                outbox.put(None)
+
+    stages = [(decode, None, detect_queue), (detect, detect_queue, track_queue),
+              (track, track_queue, write_queue), (write, write_queue, None)]
+    threads = [threading.Thread(target=run_stage, args=stage) for stage in stages]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+# detects the ants in frame, unless gate (a MotionGate, or None for no gate) decides that the
+# frame is idle. returns (centers, areas), or None if the frame was skipped, in which case
+# it shouldn't be tracked either. the gate never skips while there are tracks in progress.
+# if guard (an IlluminationGuard) is given, it checks the detections of the frame, which is
+# frame_number at timestamp, for sudden changes of lighting. if mask_writer (a MaskWriter) is
+# given, the frame's foreground mask is saved to it. foreground is the frame's foreground, if it
+# has already been through the background model (see Detector.background_batch)
+def gated_detect(gate, detector_object, tracker_object, frame, guard=None, frame_number=0,
+                 timestamp=0.0, mask_writer=None, foreground=None):
+    if gate is not None and gate.skip(frame, detector_object, len(tracker_object.tracks) > 0):
+        if mask_writer is not None:
+            mask_writer.log(timestamp, None)
+        return None
+    detections = detector_object.Detect(frame, foreground)
+    if mask_writer is not None:
+        mask_writer.log(timestamp, detector_object.foreground)
+    if guard is not None:
+        detections = guard.check(detector_object, detections, frame_number, timestamp)
+    return detections
+
+
+# returns the timestamp of every frame of source from its frame index, or an empty
+# list if the index can't be built (the video reader's timestamps are used instead)
+def load_timestamps(source):
+    try:
+        return frameindex.segment_timestamps(source)
+    except RuntimeError as e:
+        print("WARNING: couldn't build the frame index, using the video reader's timestamps\n", e)
+        return []
+
+
+# runs the tracker on the ants detected on frame frame_counter, which is at time current_timestamp.
+# bounds is (x_bound_left, x_bound_right, y_bound_bottom, y_bound_top) for the ROI being tracked.
+# everything the tracker knows about the clip is kept in tracker_object, so each ROI of a split
+# can have its own tracker (see track_split.py)
+def track_detections(tracker_object, centers, areas, source, no_ant_counter_frames_total, bounds,
+                     frame_counter, current_timestamp):
+    x_bound_left, x_bound_right, y_bound_bottom, y_bound_top = bounds
+    fps = tracker_object.fps
+    tracker_object.frame_counter = frame_counter
+    tracker_object.current_timestamp = current_timestamp
+
+    # checks if ant has left the frame
+    for i in range(len(tracker_object.tracks)):
+        try:
+            track_id = tracker_object.tracks[i].track_id
+
+            # checks if ant is seen on the frame at the moment.
+            # note this might trigger if an ant has "blipped" out of existence for one frame.
+            if frame_counter - tracker_object.tracks[i].frame_last_seen > 0:
+                tracker_object.tracks[i].exists_on_frame = False
+
+            place_last_seen = tuple(int(value[0]) for value in tracker_object.tracks[i].trace[-1])
+
+            # if the ant disappeared near the edge, we will give it no_ant_counter_frames_total number of frames 
+            # to reappear. otherwise, it will be considered gone and the active track will be deleted (it will
+            # still remain in the history)
+            if x_bound_left <= place_last_seen[0] <= x_bound_right and y_bound_bottom <= place_last_seen[1] <= y_bound_top:  # by the border
+                gone_frames = no_ant_counter_frames_total * 1  # change scalar
+
+            # if the ant disappeared in the middle, we will be more generous and give it no_ant_counter_frames_total
+            # times 2 frames to reappear. otherwise it will be considered gone and will be flagged as "end_middle"
+            # PLEASE FEEL FREE TO CHANGE THE SCALAR --> IT DOESN'T HAVE TO BE * 2
+            else:  # disappeared in the middle:
+                gone_frames = no_ant_counter_frames_total * 2  # change scalar
+                
+            # the ant hasn't been seen in awhile, so we will now delete its corresponding active track
+            if frame_counter - tracker_object.tracks[i].frame_last_seen > gone_frames:
+                time_last_seen = round(current_timestamp - gone_frames / fps, 2)
+                place_last_seen = tuple(int(value[0]) for value in tracker_object.tracks[i].trace[-1])
+                
+                print(f"Ant {track_id} last seen {place_last_seen} at time {time_last_seen}")
+
+                tracker_object.tracks[i].x1 = place_last_seen[0]
+                tracker_object.tracks[i].y1 = place_last_seen[1]
+                tracker_object.tracks[i].t1 = time_last_seen
+
+                # if the ant disappeared within the borders of the frame dictated by edge_border
+                if x_bound_left <= place_last_seen[0] <= x_bound_right and y_bound_bottom <= place_last_seen[1] <= y_bound_top:
+                    print(f"WARNING: Ant {track_id} disappeared in the middle")
+
+                    tracker_object.tracks[i].appear_middle_end = True  # this will flag "end_middle" as true
+
+
+                # it is possible an ant leaves while merged with another ant
+                # we will assume the ants eventually unmerged, so the new unmerge time will be the time
+                # the ant was last seen
+                if tracker_object.tracks[i].attached_to_me > 0:
+                    print(f"Merged ant {tracker_object.tracks[i].track_id} left. There was no unmerger")
+                    tracker_object.tracks[i].unmerge_time.append(time_last_seen)
+
+
+                # delete now obselete active track (and free its slot in the kalman filter).
+                # remember every active track is also in the histories list, at the index of its id,
+                # so all of this information stays there
+                print(f"Removed ant {tracker_object.tracks[i].track_id} from active tracks list\n")
+                tracker_object.filter.remove(tracker_object.tracks[i].slot)
+                del tracker_object.tracks[i]
+                del tracker_object.assignment[i]
+        except:
+            pass
+
+    # if ants were detected on frame
+    if len(centers) > 0:
+
+        # make new updated predictions with given coordinates
+        tracker_object.Update(centers, areas)
+
+        # when ants are detected for the first time (they entered the frame for the first time)
+        for i in range(len(tracker_object.tracks)):
+            # first_shoutout checks if initial information was already gathered
+            # if it has, don't gather it again (as it will override the correct information)
+            if tracker_object.tracks[i].first_shoutout:
+                continue
+            else:
+                time_first_seen = current_timestamp
+
+                start = os.path.abspath(__file__)   # relative path of source
+                relative_path = os.path.relpath(source, start)
+
+                track_id = tracker_object.tracks[i].track_id
+                
+                # IMPORTANT: the place_first seen is actually NOT set to trace[0]. this is because the tracker
+                # sets the initial position quite far away from the actual ant, and takes around 2 frames
+                # for the tracker to properly adjust the position
+                # We set all info for trace[0] and trace[1] in case the trace never gets that long, and then
+                # when we get to trace[2] we call that the first time the ant was seen (set first_shoutout)
+
+                if len(tracker_object.tracks[i].trace) == 0:
+                    place_first_seen = (-1,-1)
+                else:
+                    place_first_seen = tuple(int(value[0]) for value in tracker_object.tracks[i].trace[-1])
+                if len(tracker_object.tracks[i].trace) == 3:
+                    print(f"Ant {track_id} first seen: {place_first_seen} at time {time_first_seen}")
+                    tracker_object.tracks[i].first_shoutout = True
+
+                # detects if the ant appeared in the middle (threshold determined by edge_border)
+                if x_bound_left <= place_first_seen[0] <= x_bound_right and y_bound_bottom <= place_first_seen[1] <= y_bound_top:
+                    print(f"WARNING: Ant {track_id} appeared in the middle")
+                    tracker_object.tracks[i].appear_middle_begin = True
+
+                # store relevant information
+                tracker_object.tracks[i].filename = relative_path
+                tracker_object.tracks[i].x0 = place_first_seen[0]
+                tracker_object.tracks[i].y0 = place_first_seen[1]
+                tracker_object.tracks[i].t0 = time_first_seen
+
+
+# each track gets displayed in a different color (avoids confusion)
+# remember we use bgr not rgb
+# we draw the id on top of the ant as well as the trace
+def draw_tracks(frame, tracker_object):
+    for track in tracker_object.tracks:
+        trace = [(int(point[0][0]), int(point[1][0])) for point in track.trace]
+        draw_trace(frame, track.track_id, trace)
+
+
 # this function writes and saves the contents of histories into a csv file
 def make_history_CSV(tracker_object, history_path):
     full_list_history = []
@@ -288,66 +628,31 @@ def make_history_CSV(tracker_object, history_path):
     return history_path
 
 
-# outputs parts of the video where mergers were detected
-# there are two outputs: one annotated and one without
-# this won't run if there were no merges detected
-def make_merge_vids(history_csv, video_source, annotated_video_source, result_path, annotated_result_path):
-
-    # the goal is to "combine" relatively similar times
-    with open(history_csv, 'r') as file:
-        reader = csv.DictReader(file)
-        range_of_times = []
-
-        for row in reader:
-            # return merge_time and unmerger_time as a list
-            merge_time = row.get('merge_time').split()
-            unmerge_time = row.get('unmerge_time').split()
-
-            id = row.get('id')
-
-            if len(merge_time) > 0 and len(unmerge_time) > 0:
-                first_one = True
-                begin_time = 0
-
-                for unmerge in unmerge_time:
-                    unmerge = float(unmerge)
-                    for merge in merge_time:
-                        merge = float(merge)
-                        if first_one:
-                            first_one = False
-                            begin_time = merge
-
-                        # obviously this isn't possible, so we break
-                        if merge > unmerge:
-                            merge_time = merge_time[merge_time.index(str(merge)):]
-                            # first_one = True
-                            break
+# saves the sudden changes of lighting found by an IlluminationGuard, one row per change, with the
+# frame and time at which the background was reset, why (too much 'foreground' or too many 'blobs'),
+# and the fraction of the frame which was foreground and the number of ants found on it
+def make_events_CSV(events, events_path):
+    if not os.path.exists(os.path.dirname(os.path.abspath(events_path))):
+        os.makedirs(os.path.dirname(os.path.abspath(events_path)))
 
-                    first_one = True
-                    range_of_times.append((floor(begin_time) - 5, ceil(unmerge) + 5))  # we will add 5 seconds of padding
-
-                # crops times
-                if range_of_times != []:
-                    for index, time in enumerate(range_of_times):
-                        from_time, to_time = time
-
-                        # calls ffmpeg to trim videos at specific times
-                        # Construct the file paths for the results and annotated results
-                        final_result_path = os.path.join(result_path, f'ID_{id}_part_{index}.mp4')
-                        final_annotated_result_path = os.path.join(annotated_result_path, f'ID_{id}_part_{index}.mp4')
-
-                        # Create the directories if they don't exist
-                        os.makedirs(os.path.dirname(final_result_path), exist_ok=True)
-                        os.makedirs(os.path.dirname(final_annotated_result_path), exist_ok=True)
-
-                        # Process the videos using FFmpeg
-                        ffmpeg_command = f'ffmpeg -y -i {video_source} -ss {from_time} -to {to_time} -c copy -loglevel error {final_result_path}'
-                        os.system(ffmpeg_command)
+    with open(events_path, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["frame", "time", "reason", "foreground", "blobs"])
+        writer.writerows(events)
 
-                        ffmpeg_command = f'ffmpeg -y -i {annotated_video_source} -ss {from_time} -to {to_time} -c copy -loglevel error {final_annotated_result_path}'
-                        os.system(ffmpeg_command)
+    return events_path
 
-                range_of_times = []
 
-            else:
-                print("Uh oh, there are more unmerge times and merge times. I don't know what to do!")
+# outputs parts of the video where mergers were detected
+# there are two outputs: one annotated and one without
+# this won't run if there were no merges detected
+# annotated_video_source may also be an overlay log, in which case the annotated clips are rendered
+# from it (see overlay.py), using the trace length the clip was tracked with.
+# overlapping merges are cut as one clip, which are listed in a merges manifest in result_path.
+# if defer is set, only the manifest is written, and the clips are cut later by mergeclips.py
+def make_merge_vids(history_csv, video_source, annotated_video_source, result_path, annotated_result_path,
+                    trace_length=constants.TRACKER_TRACE_LENGTH, cores=1, defer=False):
+    manifest = mergeclips.write_manifest(history_csv, video_source, annotated_video_source,
+                                         result_path, annotated_result_path, trace_length)
+    if manifest is not None and not defer:
+        mergeclips.cut_clips(manifest, cores)
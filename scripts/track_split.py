@@ -0,0 +1,439 @@
+import argparse
+import os, os.path
+
+import cv2
+import numpy as np
+
+import bbox
+import croprotate
+from framereader import open_capture
+import constants
+import detectioncache
+import maskcache
+from detector import Detector, MotionGate, IlluminationGuard, RoiMask, SharedBackground, load_background, save_background
+from track_one_clip import track_detections, make_history_CSV, make_events_CSV, make_merge_vids, \
+    load_timestamps, FrameClock
+from tracker import Tracker
+from track import add_tracking_arguments
+
+
+class RoiTracker:
+    """Holds everything needed to track the ants in one ROI of a split:
+    the remap tables which pull the ROI out of a full frame, and the
+    detector and tracker which run on the result.
+    """
+
+    def __init__(self, box, edge_border, detector_object, tracker_object, gate=None, mask=None,
+                 guard=None):
+        self.map_x, self.map_y = box.crop_maps()  # built once per ROI
+        self.roi_mask = RoiMask(mask) if mask is not None else None  # the ROI's polygon, if used
+        height, width = self.map_x.shape
+        self.bounds = (edge_border, width - edge_border,
+                       edge_border, height - edge_border)
+        self.detector_object = detector_object
+        self.tracker_object = tracker_object
+        self.gate = gate  # this ROI's MotionGate, or None
+        self.guard = guard  # this ROI's IlluminationGuard, or None
+
+    def crop(self, frame):
+        """Returns the rotated crop of this ROI from the full frame."""
+        return cv2.remap(frame, self.map_x, self.map_y, cv2.INTER_LINEAR)
+
+    def detect(self, image, frame_counter, current_timestamp, mask=None, batched=None):
+        """Returns (centers, areas) of the ants in this ROI, given its crop
+        of frame frame_counter (at time current_timestamp), or None if the
+        motion gate skipped it. mask is this ROI's part of the shared
+        foreground mask, if it uses one. batched is the crop's foreground,
+        if it has already been through the ROI's background model (see
+        Detector.background_batch).
+        """
+        if self.gate is not None and self.gate.skip(image, self.detector_object,
+                                                    len(self.tracker_object.tracks) > 0):
+            return None
+        detections = self.detector_object.Detect(image if mask is None else mask, batched)
+        if self.guard is not None:
+            detections = self.guard.check(self.detector_object, detections,
+                                          frame_counter, current_timestamp)
+        return detections
+
+
+class RoiAtlas:
+    """Cuts every ROI out of a frame with a single remap, into one image
+    (the atlas) which holds the pixels of each ROI's crop one after the
+    other. Each ROI's crop is then a view of the atlas, and the atlas can
+    go through one shared background model instead of one for each ROI.
+    If an ROI has a mask, only its pixels inside the polygon are put into
+    the atlas, so the shared background model never sees the rest.
+    """
+
+    # the width of the atlas. remap can't make images wider than 32767 pixels, so the ROIs
+    # are laid out row after row, and each one is reshaped back into its crop
+    WIDTH = 1024
+
+    def __init__(self, rois):
+        self.shapes = [roi.map_x.shape for roi in rois]
+        self.masks = [roi.roi_mask for roi in rois]
+        # the (flat) index in the crop of each pixel of the ROI which is in the atlas
+        inside = [np.arange(roi.map_x.size) if roi.roi_mask is None else roi.roi_mask.inside
+                  for roi in rois]
+        self.offsets = np.cumsum([0] + [len(pixels) for pixels in inside])  # where each ROI's pixels start
+        rows = -(-self.offsets[-1] // self.WIDTH)
+        # the space after the last ROI maps outside the frame, so it stays black
+        self.map_x = np.full(rows * self.WIDTH, -1, np.float32)
+        self.map_y = np.full(rows * self.WIDTH, -1, np.float32)
+        for roi, pixels, start, end in zip(rois, inside, self.offsets, self.offsets[1:]):
+            self.map_x[start:end] = roi.map_x.ravel()[pixels]
+            self.map_y[start:end] = roi.map_y.ravel()[pixels]
+        self.map_x = self.map_x.reshape(rows, self.WIDTH)
+        self.map_y = self.map_y.reshape(rows, self.WIDTH)
+
+    def warp(self, frame):
+        """Returns the atlas of the frame. Each pixel is worked out in the
+        same way as by RoiTracker.crop, so the crops are the same.
+        """
+        return cv2.remap(frame, self.map_x, self.map_y, cv2.INTER_LINEAR)
+
+    def view(self, atlas, i):
+        """Returns ROI i's crop, as a view of the atlas (or of its mask).
+        If the ROI has a mask, the crop is a copy instead, which is black
+        outside the polygon.
+        """
+        pixels = atlas.reshape(-1, *atlas.shape[2:])[self.offsets[i]:self.offsets[i+1]]
+        if self.masks[i] is not None:
+            crop = np.zeros((*self.shapes[i], *atlas.shape[2:]), atlas.dtype)
+            crop.reshape(-1, *atlas.shape[2:])[self.masks[i].inside] = pixels
+            return crop
+        return pixels.reshape(*self.shapes[i], *atlas.shape[2:])
+
+    def put(self, atlas, i, crop):
+        """Copies ROI i's crop (e.g. a saved background) into the atlas."""
+        pixels = crop.reshape(-1, *crop.shape[2:])
+        if self.masks[i] is not None:
+            pixels = pixels[self.masks[i].inside]
+        atlas.reshape(-1, *atlas.shape[2:])[self.offsets[i]:self.offsets[i+1]] = pixels
+
+
+def background_path(directory, i):
+    """Returns where the background of ROI i is saved in directory."""
+    return os.path.join(directory, f'ROI_{croprotate.ROI_NAMES[i]}.png')
+
+
+def trackSplit(
+        source, boxes, minBlob, num_gaussians,
+        canny_threshold_one, canny_threshold_two, canny_aperture_size,
+        thresholding_threshold, dilating_matrix, tracker_distance_threshold,
+        tracker_trace_length, no_ant_counter_frames_total, edge_border,
+        merge_distance, frame_index=False, frame_reader='opencv', decoder_threads=0,
+        motion_gate=False, motion_threshold=constants.MOTION_THRESHOLD,
+        background_every=constants.BACKGROUND_EVERY, blob_method=constants.BLOB_METHOD,
+        detector_stages=constants.DETECTOR_STAGES, shared_background=False, roi_mask=False,
+        roi_mask_padding=constants.ROI_MASK_PADDING,
+        background_model=constants.BACKGROUND_MODEL, median_threshold=constants.MEDIAN_THRESHOLD,
+        median_update_every=constants.MEDIAN_UPDATE_EVERY, median_batch=constants.MEDIAN_BATCH,
+        background_in=None, background_out=None, illumination_guard=False, illumination_max_foreground=constants.ILLUMINATION_MAX_FOREGROUND,
+        illumination_max_blobs=constants.ILLUMINATION_MAX_BLOBS,
+        illumination_hold=constants.ILLUMINATION_HOLD, events_dir=None, detections_dir=None,
+        max_blob=constants.MAX_BLOB, masks_dir=None, gated_assignment=False):
+    """Tracks the ants in every ROI of one split video, decoding the split
+    only once.
+
+    Each frame is decoded once and every ROI is cropped out of it in
+    memory, then fed straight to that ROI's own detector and tracker, so
+    no intermediate ROI videos are needed. Returns the list of tracker
+    objects, in the same order as boxes.
+
+    If shared_background is set, every ROI is cut out of the frame at once
+    into a RoiAtlas, which goes through one shared background model, and
+    each ROI's detector starts from its part of the foreground mask. The
+    background stage must then come first. Since the background model
+    works pixel by pixel, the results are the same as with a background
+    model for each ROI.
+
+    If background_in is given, it is the background_out directory of the
+    previous split, and each ROI's background model starts from the
+    background it had at the end of that split. If background_out is
+    given, the background of each ROI at the end of this split is saved
+    there for the next split.
+
+    If roi_mask is set, each ROI only looks at the pixels inside its
+    polygon (grown by roi_mask_padding pixels, see BBox.crop_mask).
+
+    If the background model takes batches (the median model), each ROI's
+    crops of median_batch frames at a time go through it together (see
+    Detector.background_batch), and the ROI then detects and tracks them
+    one after another. The ROIs don't share anything, so this gives the
+    same results as going through the frames one at a time. It isn't done
+    with the shared background, the motion gate or the illumination guard,
+    which all decide frame by frame what the background model does.
+
+    If illumination_guard is set, each ROI has an IlluminationGuard, and
+    the sudden changes of lighting it finds are saved in events_dir (if
+    given). With the shared background, a change in any ROI resets the
+    shared background model.
+
+    If detections_dir is given, the detections of each ROI are saved there
+    (see detectioncache.py), so that each ROI can be tracked again with
+    track.py --replay. Likewise, if masks_dir is given, the foreground masks
+    of each ROI are saved there (see maskcache.py), for track.py
+    --from-masks.
+    """
+    if shared_background:
+        if not detector_stages or detector_stages[0] != 'background':
+            raise ValueError('The shared background needs background to be the first detector stage')
+        detector_stages = detector_stages[1:]  # the shared background does this stage
+
+    # create video reader object (source may be a segment manifest). see framereader.py
+    cap = open_capture(source, frame_reader, decoder_threads)
+
+    # all of the ROIs share the same frame, so these are the same for every ROI. each ROI's
+    # tracker is given them with every frame it tracks, and keeps everything else to itself
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frames_read = 0
+
+    masks = [box.crop_mask(roi_mask_padding) if roi_mask else None for box in boxes]
+    rois = [RoiTracker(box, edge_border,
+                       Detector(minBlob, num_gaussians, canny_threshold_one,
+                                canny_threshold_two, canny_aperture_size,
+                                thresholding_threshold, dilating_matrix, blob_method,
+                                stages=detector_stages, background_model=background_model,
+                                median_threshold=median_threshold,
+                                median_update_every=median_update_every, mask=mask,
+                                max_blob=max_blob),
+                       Tracker(tracker_distance_threshold, tracker_trace_length,
+                               merge_distance, fps, gated_assignment),
+                       MotionGate(motion_threshold, background_every) if motion_gate else None,
+                       mask,
+                       IlluminationGuard(illumination_max_foreground, illumination_max_blobs,
+                                         illumination_hold) if illumination_guard else None)
+            for box, mask in zip(boxes, masks)]
+
+    atlas = RoiAtlas(rois) if shared_background else None
+    shared = SharedBackground(background_model, median_threshold,
+                              median_update_every) if shared_background else None
+
+    if background_in:
+        backgrounds = [load_background(background_path(background_in, i)) for i in range(len(rois))]
+        if shared is not None:
+            # put the saved backgrounds together into an atlas, like the frames
+            image = np.zeros(atlas.map_x.shape, np.uint8)
+            for i, background in enumerate(backgrounds):
+                if background is not None and background.shape == atlas.shapes[i]:
+                    atlas.put(image, i, background)
+            shared.warm_start(image)
+        else:
+            for roi, background in zip(rois, backgrounds):
+                roi.detector_object.warm_start(background, roi.map_x.shape)
+
+    writers = [detectioncache.DetectionWriter(
+                   os.path.join(detections_dir, f'ROI_{croprotate.ROI_NAMES[i]}{detectioncache.CACHE_EXT}'),
+                   source, fps, roi.map_x.shape[1], roi.map_x.shape[0])
+               for i, roi in enumerate(rois)] if detections_dir else None
+    mask_writers = [maskcache.MaskWriter(
+                        os.path.join(masks_dir, f'ROI_{croprotate.ROI_NAMES[i]}{maskcache.MASK_EXT}'),
+                        source, fps, roi.map_x.shape[1], roi.map_x.shape[0])
+                    for i, roi in enumerate(rois)] if masks_dir else None
+
+    # timestamps from the frame index, if asked for (see trackOneClip)
+    clock = FrameClock(cap, load_timestamps(source) if frame_index else [])
+
+    if atlas is not None or motion_gate or illumination_guard or \
+            not all(roi.detector_object.can_batch() for roi in rois):
+        median_batch = 1
+
+    batch = []  # (frame_counter, current_timestamp, frame) of each frame of the batch
+    while (True):
+        ret, frame = cap.read()  # read one frame
+        if ret:
+            # some readers reuse one buffer for every frame, so keep our own copy
+            batch.append((frames_read, clock.tick(frames_read),
+                          frame.copy() if median_batch > 1 else frame))
+            frames_read += 1  # an advancement of a frame
+            if len(batch) < median_batch:
+                continue
+        if not batch:
+            break  # frame is invalid or we are done with entire video
+
+        if atlas is not None:  # (the batch is then a single frame)
+            warped = atlas.warp(batch[0][2])
+            mask = shared.apply(warped)
+
+        for i, roi in enumerate(rois):
+            if atlas is not None:
+                images, foregrounds = [atlas.view(warped, i)], [atlas.view(mask, i)]
+            else:
+                images, foregrounds = [roi.crop(frame) for _, _, frame in batch], [None] * len(batch)
+            batched = [None] * len(batch)
+            if median_batch > 1:
+                batched = roi.detector_object.background_batch(images)
+            for (frame_counter, current_timestamp, _), image, foreground, background in zip(
+                    batch, images, foregrounds, batched):
+                # each ROI has its own motion gate, so idle ROIs are skipped while the others are tracked
+                detections = roi.detect(image, frame_counter, current_timestamp, foreground, background)
+                if shared is not None and roi.guard is not None and roi.guard.fired:
+                    shared.reset(warped)  # the ROI's detector has no background model of its own
+                if writers is not None:
+                    writers[i].log(current_timestamp, detections)
+                if mask_writers is not None:
+                    if detections is None:
+                        saved = None  # the motion gate skipped this frame
+                    elif foreground is not None:
+                        saved = foreground  # the ROI's part of the shared mask
+                    else:
+                        saved = roi.detector_object.foreground
+                    mask_writers[i].log(current_timestamp, saved)
+                if detections is not None:
+                    centers, areas = detections
+                    track_detections(roi.tracker_object, centers, areas, source,
+                                     no_ant_counter_frames_total, roi.bounds,
+                                     frame_counter, current_timestamp)
+
+        batch = []
+        if not ret:
+            break
+
+    cap.release()  # releases video reader
+    for writer in (writers or []) + (mask_writers or []):
+        writer.close()
+    if shared is not None:
+        shared.report_timing(source)
+
+    if background_out:
+        image = shared.background_image() if shared is not None else None
+        for i, roi in enumerate(rois):
+            if shared is not None:
+                save_background(shared.backRemove, background_path(background_out, i),
+                                atlas.view(image, i) if image is not None else None)
+            else:
+                roi.detector_object.save_background(background_path(background_out, i))
+    for i, roi in enumerate(rois):
+        if roi.gate is not None:
+            roi.gate.report(f'ROI {croprotate.ROI_NAMES[i]} of {source}')
+        if roi.guard is not None:
+            roi.guard.report(f'ROI {croprotate.ROI_NAMES[i]} of {source}')
+            if events_dir:
+                make_events_CSV(roi.guard.events,
+                                os.path.join(events_dir, f'ROI_{croprotate.ROI_NAMES[i]}.csv'))
+        roi.detector_object.report_timing(f'ROI {croprotate.ROI_NAMES[i]} of {source}')
+
+    return [roi.tracker_object for roi in rois]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('source',
+                            type=str,
+                            help='The path to a split video in which we want to '
+                                 'track the ants.')
+    arg_parser.add_argument('boxes',
+                            type=str,
+                            help='A text file from which to load the ROIs.')
+    arg_parser.add_argument('out_dir',
+                            type=str,
+                            help='The directory in which to save the history '
+                                 'csv of each ROI.')
+    arg_parser.add_argument('-sb', '--shared-background',
+                            dest='shared_background',
+                            action='store_true',
+                            help='Model the background once for all of the ROIs, '
+                                 'and cut the foreground of each ROI out of it, '
+                                 'instead of modelling each ROI separately.')
+    arg_parser.add_argument('-rm', '--roi-mask',
+                            dest='roi_mask',
+                            action='store_true',
+                            help="Only detect ants inside each ROI's polygon, "
+                                 'instead of in the whole rectangle around it.')
+    arg_parser.add_argument('-dc', '--detection-cache',
+                            dest='detection_cache',
+                            action='store_true',
+                            help='Save the detections of each ROI in the '
+                                 'detections directory of out_dir, so the ROIs '
+                                 'can be tracked again with track.py --replay.')
+    arg_parser.add_argument('-fm', '--foreground-masks',
+                            dest='foreground_masks',
+                            action='store_true',
+                            help='Save the foreground masks of each ROI in the '
+                                 'masks directory of out_dir, so the ROIs can be '
+                                 'detected and tracked again with track.py '
+                                 '--from-masks.')
+    arg_parser.add_argument('-bi', '--background-in',
+                            dest='background_in',
+                            type=str,
+                            default=None,
+                            help='A directory with the backgrounds of the ROIs '
+                                 'at the end of the previous split (saved with '
+                                 '--background-out), to start from instead of '
+                                 'learning the background from scratch.')
+    arg_parser.add_argument('-bo', '--background-out',
+                            dest='background_out',
+                            type=str,
+                            default=None,
+                            help='A directory in which to save the background of '
+                                 'each ROI at the end of this split.')
+    arg_parser.add_argument('-dfm', '--defer-merges',
+                            dest='defer_merges',
+                            action='store_true',
+                            help='Only list the merge clips in merger/.../merges.json, '
+                                 'instead of cutting them. They can be cut later, when '
+                                 'someone wants to look at them, with mergeclips.py.')
+    arg_parser.add_argument('-mc', '--merge-cores',
+                            dest='merge_cores',
+                            type=int,
+                            default=1,
+                            help='The number of merge clips to cut at the same time '
+                                 '(default 1).')
+    add_tracking_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    print('Tracking ants in every ROI of', args.source)
+    boxes = bbox.read_bboxes(args.boxes)
+    tracker_objects = trackSplit(args.source, boxes,
+                 args.min_blob, args.gaussians,
+                 args.canny_threshold_one, args.canny_threshold_two,
+                 args.canny_aperture_size, args.thresholding_threshold,
+                 args.dilating_matrix, args.tracker_distance_threshold,
+                 args.tracker_trace_length, args.no_ant_counter_frames_total,
+                 args.edge_border, args.merge_distance,
+                 frame_index=args.frame_index, frame_reader=args.frame_reader,
+                 decoder_threads=args.decoder_threads, motion_gate=args.motion_gate,
+                 motion_threshold=args.motion_threshold,
+                 background_every=args.background_every, blob_method=args.blob_method,
+                 detector_stages=args.detector_stages,
+                 shared_background=args.shared_background,
+                 roi_mask=args.roi_mask, roi_mask_padding=args.roi_mask_padding,
+                 background_model=args.background_model,
+                 median_threshold=args.median_threshold,
+                 median_update_every=args.median_update_every,
+                 median_batch=args.median_batch,
+                 background_in=args.background_in, background_out=args.background_out,
+                 illumination_guard=args.illumination_guard,
+                 illumination_max_foreground=args.illumination_max_foreground,
+                 illumination_max_blobs=args.illumination_max_blobs,
+                 illumination_hold=args.illumination_hold,
+                 events_dir=os.path.join(args.out_dir, 'events'),
+                 detections_dir=os.path.join(args.out_dir, 'detections') if args.detection_cache else None,
+                 max_blob=args.max_blob, gated_assignment=args.gated_assignment,
+                 masks_dir=os.path.join(args.out_dir, 'masks') if args.foreground_masks else None)
+
+    # the merge clips go in the same "merger" directories as track.py's, e.g. the clips of
+    # intermediate/fused/{video}/{split} go in intermediate/merger/{video}/{split}/ROI_{roi}
+    split = os.path.normpath(args.out_dir)
+    video = os.path.dirname(split)
+    intermediate = os.path.dirname(os.path.dirname(video))
+    merger_dir = os.path.join(intermediate, 'merger', os.path.basename(video), os.path.basename(split))
+
+    # makes the history csvs, named the same way as the croprotate videos
+    os.makedirs(args.out_dir, exist_ok=True)
+    for i, tracker_object in enumerate(tracker_objects):
+        roi = f'ROI_{croprotate.ROI_NAMES[i]}'
+        history_path = os.path.join(args.out_dir, f'{roi}.csv')
+        final_result_path_history = make_history_CSV(tracker_object, history_path)
+
+        # makes the merge videos. there are no ROI videos to cut them from, so they are cut
+        # from the split (the whole frame), and there is no annotated video to cut them from
+        make_merge_vids(final_result_path_history, args.source, None,
+                        os.path.join(merger_dir, roi), None,
+                        args.tracker_trace_length, args.merge_cores, args.defer_merges)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,26 +2,36 @@
 # https://github.com/srianant/kalman_filter_multi_object_tracking
 
 import numpy as np
-from kalman_filter import KalmanFilter
+from kalman_filter import BatchKalmanFilter
 from scipy.optimize import linear_sum_assignment
-import track_one_clip
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from math import sqrt
-from bisect import insort  # append to list in order
-
-# REMEMBER, HISTORY KEEPS CONTAINS INFORMATION OF ALL ANTS
-# ACTIVE_ANTS ONLY CONTAINS INFORMATION OF ACTIVE ANTS (IE ANTS THAT ARE OR RECENTLY WERE DETECTED)
-class History:
-    # track number of history objects (and therefore ants) created
-    history_num = 0
-
-    def __init__(self, prediction, trackIdCount):  # note that track_id and index for self.histories is the exact same
+from collections import deque
+from bisect import bisect_left
+
+# REMEMBER, HISTORIES CONTAINS INFORMATION OF ALL ANTS
+# TRACKS ONLY CONTAINS INFORMATION OF ACTIVE ANTS (IE ANTS THAT ARE OR RECENTLY WERE DETECTED)
+# both lists hold the same Track objects: an ant's track is added to both when it is first detected,
+# and stays in histories once it is removed from the active tracks, so nothing is ever copied between them
+class Track:
+    # a fixed set of attributes (no __dict__), since there is one of these for every ant
+    __slots__ = ('filename', 'id', 'x0', 'y0', 't0', 'x1', 'y1', 't1', 'number_warning', 'broken_track',
+                 'slot', 'prediction', 'track_id', 'frame_last_seen', 'time_last_seen', 'frame_first_seen',
+                 'time_first_seen', 'first_shoutout', 'trace', 'area_total', 'area_median', 'average_area',
+                 'area', 'median_area', 'change_in_area_window', 'change_in_area_max', 'change_in_area_min',
+                 'exists_on_frame', 'appear_middle_begin', 'appear_middle_end', 'merge_list', 'merge_time',
+                 'unmerge_list', 'unmerge_time', 'attached_to_me', 'first_merge_time', 'last_unmerge_time')
+
+    # frame_counter and current_timestamp are the frame and time at which the ant was first detected
+    def __init__(self, prediction, trackIdCount, max_trace_length, frame_counter, current_timestamp):  # note that track_id and index for self.histories is the exact same
         self.filename = ''  
-        self.id = trackIdCount  # identification number for each ant. this number is the same as the index in History
+        self.id = trackIdCount  # identification number for each ant. this number is the same as the index in histories
 
         # (x0, y0) is the coordinate the ant was first detected
         self.x0 = -1  
         self.y0 = -1
-        self.t0 = track_one_clip.current_timestamp  # time ant was first detected
+        self.t0 = current_timestamp  # time ant was first detected
 
         # (x1, y1) is the coordinate the ant was last detected
         self.x1 = -1
@@ -31,23 +41,23 @@ class History:
         self.number_warning = 0  # triggers if there are too many ants detected in a short amount of time (triggered in combinetrack.py)
         self.broken_track = 0  # triggers if the track was "broken", or if there was a large gap in distance between detections
 
-        self.KF = KalmanFilter()  # KF instance to track this object
+        self.slot = -1  # slot of this track in the tracker's BatchKalmanFilter
         self.prediction = np.asarray(prediction)  # predicted centroids (x,y)
         self.track_id = trackIdCount  # identification of each track object
         
-        self.frame_last_seen = track_one_clip.frame_counter  # continuously updated with each detection
-        self.time_last_seen = track_one_clip.current_timestamp
-        self.frame_first_seen = track_one_clip.frame_counter  # frame first detected
-        self.time_first_seen = track_one_clip.current_timestamp
+        self.frame_last_seen = frame_counter  # continuously updated with each detection
+        self.time_last_seen = current_timestamp
+        self.frame_first_seen = frame_counter  # frame first detected
+        self.time_first_seen = current_timestamp
         self.first_shoutout = False  # used to print when ant was first detected
         
-        self.trace = []  # trace path
+        self.trace = deque(maxlen=max_trace_length + 1)  # trace path (the last max_trace_length + 1 predictions)
         self.area_total = 0  # used to calculate average area
-        self.area_list = []  # used to calculate average area and median area
+        self.area_median = AreaMedian()  # used to calculate average area and median area
         self.average_area = 0 
         self.area = -1  # the area of the ant currently
         self.median_area = -1
-        self.change_in_area_list = []  # CHANGE in area, not area itself
+        self.change_in_area_window = AreaChangeWindow()  # CHANGE in area, not area itself
         self.change_in_area_max = -1  # records sudden positive spikes in change in area 
         self.change_in_area_min = 1000000  # records sudden negative spikes in change in area 
 
@@ -64,66 +74,105 @@ class History:
         self.first_merge_time = -1  # time the first merger happened (used to make merger and merger_annotation videos)
         self.last_unmerge_time = -1
 
-        History.history_num += 1
-
-
-class Active_Track:  # active ant
-    
-    def __init__(self, prediction, trackIdCount):  # note that track_id and index for self.histories is the exact same
-        self.filename = ''
-        self.id = trackIdCount
-        self.x0 = -1
-        self.y0 = -1
-        self.t0 = track_one_clip.current_timestamp
-        self.x1 = -1
-        self.y1 = -1
-        self.t1 = -1.00
-        self.number_warning = 0
-        self.broken_track = 0
-
-        # aspects of active ant
-        self.KF = KalmanFilter()  # KF instance to track this object
-        self.prediction = np.asarray(prediction)  # predicted centroids (x,y)
-        self.track_id = trackIdCount  # identification of each track object
-        
-        self.frame_last_seen = track_one_clip.frame_counter  # continuously updated with each detection
-        self.time_last_seen = track_one_clip.current_timestamp
-        self.frame_first_seen = track_one_clip.frame_counter  # frame first detected
-        self.time_first_seen = track_one_clip.current_timestamp
-        self.first_shoutout = False  # used to print when ant was first detected
-        
-        self.trace = []  # trace path
-        self.area_total = 0
-        self.area_list = []
-        self.average_area = 0
-        self.area = -1  # the area of the ant currently
-        self.median_area = -1
-        self.change_in_area_list = []
-        self.change_in_area_max = -1
-        self.change_in_area_min = 1000000
-
-        self.exists_on_frame = True
-        self.appear_middle_begin = False
-        self.appear_middle_end = False
 
-        self.merge_list = []
-        self.merge_time = []
-        self.unmerge_list = []
-        self.unmerge_time = []
-        self.attached_to_me = 0
-
-        self.first_merge_time = -1
-        self.last_unmerge_time = -1
+# the median of all the areas an ant has had. the areas are pixel counts (or the half pixels of
+# cv2.contourArea) between minBlob and max_blob, so an ant only ever has a few hundred different
+# areas however long it is tracked: this keeps how many times each one was seen (the histogram of
+# the areas, as a sorted list of the different areas and their counts), so its memory is bounded
+# by the range of valid areas instead of growing with every frame. the median is kept as a cursor
+# into the histogram, which moves at most one step with each area added
+class AreaMedian:
+    __slots__ = ('values', 'counts', 'size', 'index', 'below')
+
+    def __init__(self):
+        self.values = []  # the different areas, sorted
+        self.counts = []  # how many times each of them was added
+        self.size = 0  # how many areas were added
+        self.index = 0  # the median is values[index]
+        self.below = 0  # how many areas are smaller than the median
+
+    def __len__(self):
+        return self.size
+
+    def add(self, area):
+        i = bisect_left(self.values, area)
+        if i < len(self.values) and self.values[i] == area:
+            self.counts[i] += 1
+        else:
+            self.values.insert(i, area)
+            self.counts.insert(i, 1)
+            if i <= self.index and self.size > 0:
+                self.index += 1
+        if area < self.values[self.index]:
+            self.below += 1
+        self.size += 1
+
+        # the median is the area at position len // 2 of the sorted areas (for an even number of
+        # areas that's the larger of the middle two, as area_list[len // 2] of the sorted list used to be)
+        middle = self.size // 2
+        while middle < self.below:
+            self.index -= 1
+            self.below -= self.counts[self.index]
+        while middle >= self.below + self.counts[self.index]:
+            self.below += self.counts[self.index]
+            self.index += 1
+
+    def median(self):
+        return self.values[self.index]
+
+
+# the largest and smallest of the last changes in an ant's area, kept in two monotonic deques of
+# (number of the change, change): each one only holds the changes which could still become the
+# largest (or smallest) before they leave the window, so each change costs O(1) on average instead
+# of looking through the whole window
+class AreaChangeWindow:
+    __slots__ = ('count', 'maxima', 'minima')
+
+    def __init__(self):
+        self.count = 0
+        self.maxima = deque()
+        self.minima = deque()
+
+    # adds the next change, and forgets the changes which are no longer among the last size changes
+    def add(self, change, size):
+        self.count += 1
+        while self.maxima and self.maxima[-1][1] <= change:
+            self.maxima.pop()
+        self.maxima.append((self.count, change))
+        while self.minima and self.minima[-1][1] >= change:
+            self.minima.pop()
+        self.minima.append((self.count, change))
+
+        while self.maxima[0][0] <= self.count - size:
+            self.maxima.popleft()
+        while self.minima[0][0] <= self.count - size:
+            self.minima.popleft()
+
+    def max(self):
+        return self.maxima[0][1]
+
+    def min(self):
+        return self.minima[0][1]
 
 
 class Tracker:
-    def __init__(self, dist_thresh, max_trace_length, merge_distance):
+    def __init__(self, dist_thresh, max_trace_length, merge_distance, fps, gated_assignment=False):
         """
             dist_thresh: distance threshold. When exceeds the threshold,
                          track will be deleted and new track is created
             max_trace_length: trace path history length
+            fps: frame rate of the video being tracked
+            gated_assignment: assign the detections to the tracks with
+                         assign_gated instead of assign_full (see below)
+            frame_counter, current_timestamp: the frame being tracked and its
+                         time, set by whoever feeds the tracker each frame
+                         (see track_one_clip.track_detections)
+            assignment: the detection assigned to each active track on the
+                        last Update (-1 if none)
             tracks: moniters active tracks and manages each tracks' data
-            histories: moniters all previous and current tracks
+            filter: kalman filter of all active tracks
+            histories: moniters all previous and current tracks (the
+                       active tracks are the same objects as in tracks)
             trackIdCount: identification of each track object
         """
 
@@ -131,158 +180,186 @@ class Tracker:
         self.max_trace_length = max_trace_length
         self.merge_distance = merge_distance
         self.tracks = []  # ACTIVE TRACKS
+        self.filter = BatchKalmanFilter()
         self.histories = []
         self.trackIdCount = 0
+        self.fps = fps
+        self.frame_counter = 0
+        self.current_timestamp = 0.0
+        self.assignment = []
+        self.gated_assignment = gated_assignment
+
+
+    @staticmethod
+    # assigns detections to tracks given the (N tracks, M detections) cost matrix, the original
+    # way: the Hungarian algorithm pairs up as many tracks and detections as it can over the whole
+    # matrix, and the pairs further apart than dist_thresh are then thrown away. returns the index
+    # of the detection assigned to each track (-1 if none), and the tracks the Hungarian algorithm
+    # paired, which count as seen on this frame even if their pair was thrown away
+    def assign_full(cost, dist_thresh):
+        assignment = [-1] * cost.shape[0]
+        row_ind, col_ind = linear_sum_assignment(cost)
+        for i, j in zip(row_ind.tolist(), col_ind.tolist()):
+            if cost[i, j] <= dist_thresh:
+                assignment[i] = j
+        return assignment, row_ind.tolist()
 
 
     @staticmethod
-    # updates the history object to be the same as the active track object
-    def copy_track_to_history(history, active_track):
-        history.filename = active_track.filename
-        history.id = active_track.id
-        history.x0 = active_track.x0
-        history.y0 = active_track.y0
-        history.t0 = active_track.t0
-        history.x1 = active_track.x1
-        history.y1 = active_track.y1
-        history.t1 = active_track.t1
-        history.number_warning = active_track.number_warning
-        history.broken_track = active_track.broken_track
-        history.frame_last_seen = active_track.frame_last_seen
-        history.time_last_seen = active_track.time_last_seen
-        history.frame_first_seen = active_track.frame_first_seen
-        history.time_first_seen = active_track.time_first_seen
-        history.first_shoutout = active_track.first_shoutout
-        history.trace = active_track.trace
-        history.area_total = active_track.area_total
-        history.area_list = active_track.area_list
-        history.average_area = active_track.average_area
-        history.area = active_track.area
-        history.median_area = active_track.median_area
-        history.change_in_area_list = active_track.change_in_area_list
-        history.change_in_area_max = active_track.change_in_area_max
-        history.change_in_area_min = active_track.change_in_area_min
-        history.exists_on_frame = active_track.exists_on_frame
-        history.appear_middle_begin = active_track.appear_middle_begin
-        history.appear_middle_end = active_track.appear_middle_end
-        history.merge_list = active_track.merge_list
-        history.merge_time = active_track.merge_time
-        history.unmerge_list = active_track.unmerge_list
-        history.unmerge_time = active_track.unmerge_time
-        history.attached_to_me = active_track.attached_to_me
-        history.first_merge_time = active_track.first_merge_time
-        history.last_unmerge_time = active_track.last_unmerge_time
-
-        return history
+    # does the same as assign_full, but much faster when many ants are tracked at once. the pairs
+    # further apart than dist_thresh are pruned, which splits the tracks and detections into groups
+    # (the connected components of the pairs which are close enough), and each group is assigned on
+    # its own with the Hungarian algorithm. a track and a detection which are only close to each
+    # other are a group of their own, and are paired without solving anything. the tracks and
+    # detections left over are then paired among themselves (those pairs are all too far apart),
+    # so that the same number of tracks counts as seen as with assign_full.
+    # the result is the same as assign_full's unless a pair too far apart would have pulled a
+    # detection away from its nearest track in the whole matrix, or there are ties
+    def assign_gated(cost, dist_thresh):
+        N, M = cost.shape
+        assignment = np.full(N, -1)
+        paired = np.zeros(N, dtype=bool)  # the tracks paired so far
+        used = np.zeros(M, dtype=bool)  # and the detections
+        gated = cost <= dist_thresh
+        rows, cols = np.nonzero(gated)
+
+        # a track and a detection which are only close to each other are a group of their own
+        track_counts, detect_counts = gated.sum(axis=1), gated.sum(axis=0)
+        single = (track_counts[rows] == 1) & (detect_counts[cols] == 1)
+        assignment[rows[single]] = cols[single]
+        paired[rows[single]] = used[cols[single]] = True
+        rows, cols = rows[~single], cols[~single]
+
+        if len(rows) > 0:
+            # the rest are grouped with the connected components of the pairs which are left,
+            # where tracks are nodes 0..N-1 and detections are nodes N..N+M-1
+            graph = coo_matrix((np.ones(len(rows)), (rows, N + cols)), shape=(N + M, N + M))
+            _, labels = connected_components(graph, directed=False)
+
+            # the tracks (and detections) of each group, found by sorting them by group once
+            tracks, detects = np.unique(rows), np.unique(cols)
+            tracks = tracks[np.argsort(labels[tracks], kind='stable')]
+            detects = detects[np.argsort(labels[N + detects], kind='stable')]
+            _, track_starts = np.unique(labels[tracks], return_index=True)
+            _, detect_starts = np.unique(labels[N + detects], return_index=True)
+
+            for group_tracks, group_detects in zip(np.split(tracks, track_starts[1:]),
+                                                   np.split(detects, detect_starts[1:])):
+                # a pruned pair costs more than any set of pairs which are close enough, so that
+                # as many pairs as possible are assigned before the distances are minimised
+                group_cost = cost[np.ix_(group_tracks, group_detects)]
+                group_gated = group_cost <= dist_thresh
+                pruned = dist_thresh * min(len(group_tracks), len(group_detects)) + 1
+                row_ind, col_ind = linear_sum_assignment(np.where(group_gated, group_cost, pruned))
+                close = group_gated[row_ind, col_ind]
+                assignment[group_tracks[row_ind[close]]] = group_detects[col_ind[close]]
+                paired[group_tracks[row_ind]] = used[group_detects[col_ind]] = True
+
+        # pair up the tracks and detections which are left over, as the Hungarian algorithm over the
+        # whole matrix would have (these pairs are all thrown away, but the tracks count as seen)
+        left_tracks, left_detects = np.flatnonzero(~paired), np.flatnonzero(~used)
+        if len(left_tracks) > 0 and len(left_detects) > 0:
+            row_ind, _ = linear_sum_assignment(cost[np.ix_(left_tracks, left_detects)])
+            paired[left_tracks[row_ind]] = True
+
+        return assignment.tolist(), np.flatnonzero(paired).tolist()
 
 
     def Update(self, centers, areas):
+        # centers is an (M, 2) array of (x, y) (see Detector.Detect), but the tracker and
+        # kalman filter work with (2, 1) columns
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2, 1)
+
         # Create tracks if no tracks vector found
         if (len(self.tracks) == 0):
             for i in range(len(centers)):
-                track = Active_Track(centers[i], self.trackIdCount)
-                history = History(centers[i], self.trackIdCount)
+                track = Track(centers[i], self.trackIdCount, self.max_trace_length,
+                              self.frame_counter, self.current_timestamp)
+                track.slot = self.filter.add()
                 self.trackIdCount += 1
                 self.tracks.append(track)
-                self.histories.append(history)
+                self.histories.append(track)
 
 
-        # Calculate cost using sum of square distance between
-        # predicted vs detected centroids
+        # Calculate cost using the distance between predicted vs detected
+        # centroids, for every pair at once
         N = len(self.tracks)
         M = len(centers)
-        cost = np.zeros(shape=(N, M))   # Cost matrix
-        for i in range(len(self.tracks)):
-            for j in range(len(centers)):
-                try:
-                    diff = self.tracks[i].prediction - centers[j]
-                    distance = np.sqrt(diff[0][0]**2 + diff[1][0]**2)
-                    cost[i][j] = distance
-                except:
-                    pass
+        predictions = np.array([track.prediction for track in self.tracks], dtype=np.float64).reshape(N, 2)
+        diff = predictions[:, np.newaxis, :] - centers[np.newaxis, :, :, 0]
+        cost = 0.5 * np.sqrt((diff**2).sum(axis=2))  # Cost matrix
 
-        cost = 0.5 * cost  # average squared ERROR
         # Hungarian Algorithm: assign correct detected measurements to predict tracks
-        
-        global assignment
-        assignment = []
-        for _ in range(N):
-            assignment.append(-1)
-        row_ind, col_ind = linear_sum_assignment(cost)
-        for i in range(len(row_ind)):
-            assignment[row_ind[i]] = col_ind[i]
-
-        # Identify tracks with no assignment, if any
-        un_assigned_tracks = []
-        for i in range(len(assignment)):
-            if (assignment[i] != -1):
-                if cost[i][assignment[i]] > self.dist_thresh:
-                    assignment[i] = -1
-                    un_assigned_tracks.append(i)
+        assign = Tracker.assign_gated if self.gated_assignment else Tracker.assign_full
+        assignment, paired = assign(cost, self.dist_thresh)
+        self.assignment = assignment
 
-                # update frame_last_seen and time_last_seen
-                self.tracks[i].frame_last_seen = track_one_clip.frame_counter
-                self.tracks[i].time_last_seen = track_one_clip.current_timestamp
-                self.tracks[i].exists_on_frame = True
+        # update frame_last_seen and time_last_seen
+        # (of every track which was paired, even if the pair was too far apart)
+        for i in paired:
+            self.tracks[i].frame_last_seen = self.frame_counter
+            self.tracks[i].time_last_seen = self.current_timestamp
+            self.tracks[i].exists_on_frame = True
 
         # Deletion of tracks done in track_one_clip
 
         # Now look for un_assigned detects
+        assigned_detects = set(assignment)
         un_assigned_detects = []
         for i in range(len(centers)):
-            if i not in assignment:
+            if i not in assigned_detects:
                 un_assigned_detects.append(i)
 
         # Start new tracks
-        # Also start new history
+        # (which are also the new histories)
         if (len(un_assigned_detects) != 0):
             for i in range(len(un_assigned_detects)):
-                track = Active_Track(centers[un_assigned_detects[i]], self.trackIdCount)
-                history = History(centers[i], self.trackIdCount)
+                track = Track(centers[un_assigned_detects[i]], self.trackIdCount, self.max_trace_length,
+                              self.frame_counter, self.current_timestamp)
+                track.slot = self.filter.add()
                 self.trackIdCount += 1
                 self.tracks.append(track)
-                self.histories.append(history)
+                self.histories.append(track)
 
-        # Update KalmanFilter state, lastResults and tracks trace
+        # Update KalmanFilter state of every track which was assigned (or not) a detection at
+        # once. the tracks which were just started are left until the next frame
+        slots = np.array([self.tracks[i].slot for i in range(len(assignment))], dtype=np.intp)
+        detected = np.array(assignment) != -1
+        predictions = self.filter.update(slots, centers[np.where(detected, assignment, 0)], detected)
+
+        # Update lastResults and tracks trace
         for i in range(len(assignment)):
-            self.tracks[i].KF.predict()
+            self.tracks[i].prediction = predictions[i]
 
             if (assignment[i] != -1):
                 # self.tracks[i].skipped_frames = 0
-                self.tracks[i].prediction = self.tracks[i].KF.correct(centers[assignment[i]], 1)
                 
                 change = areas[assignment[i]] - self.tracks[i].area
-                self.tracks[i].change_in_area_list.append(change)
-
-                if len(self.tracks[i].change_in_area_list) >= round(track_one_clip.fps):  # keeps area limited
-                    self.tracks[i].change_in_area_list.pop(0)
+                # keeps area limited (to the last round(fps) - 1 changes)
+                self.tracks[i].change_in_area_window.add(change, round(self.fps) - 1)
 
                 # get max and min area in average list
-                self.tracks[i].change_in_area_max = max(self.tracks[i].change_in_area_list)
-                self.tracks[i].change_in_area_min = min(self.tracks[i].change_in_area_list)
+                self.tracks[i].change_in_area_max = self.tracks[i].change_in_area_window.max()
+                self.tracks[i].change_in_area_min = self.tracks[i].change_in_area_window.min()
 
                 self.tracks[i].area = areas[assignment[i]]
 
                 # print(f"ANT ID: {self.tracks[i].track_id}. AREA: {self.tracks[i].area}")
                 
                 self.tracks[i].area_total += self.tracks[i].area
-                insort(self.tracks[i].area_list, self.tracks[i].area)
-                self.tracks[i].average_area = round(self.tracks[i].area_total / len(self.tracks[i].area_list), 2)
+                self.tracks[i].area_median.add(self.tracks[i].area)
+                self.tracks[i].average_area = round(self.tracks[i].area_total / len(self.tracks[i].area_median), 2)
 
                 # calculate median area
-                self.tracks[i].median_area = self.tracks[i].area_list[len(self.tracks[i].area_list) // 2]
+                self.tracks[i].median_area = self.tracks[i].area_median.median()
 
             else:
-                self.tracks[i].prediction = self.tracks[i].KF.correct(np.array([[0], [0]]), 0)
                 self.tracks[i].area = 0  # since not detected, area must be zero
                 # though if needed, we can change this to previously recorded area
-            if (len(self.tracks[i].trace) > self.max_trace_length):
-                for j in range(len(self.tracks[i].trace) - self.max_trace_length):
-                    del self.tracks[i].trace[j]
 
+            # the trace drops its oldest prediction by itself once it is full
             self.tracks[i].trace.append(self.tracks[i].prediction)
-            self.tracks[i].KF.lastResult = self.tracks[i].prediction
-            fps = round(track_one_clip.fps)
+            fps = round(self.fps)
 
             # we are now detecting potential mergers
             if self.tracks[i].change_in_area_max >= self.tracks[i].median_area // 2:
@@ -291,7 +368,7 @@ class Tracker:
                 # looking for ant that has recently disappeared for awhile
                 # this ant may still be considered an active track, it just wasn't seen
                 for j in range(len(self.tracks)):
-                    if fps > track_one_clip.frame_counter - self.tracks[j].frame_last_seen > fps // 4: 
+                    if fps > self.frame_counter - self.tracks[j].frame_last_seen > fps // 4: 
                         if len(self.tracks[j].trace) == 0: # occasionally trace does not exist, because this ant just appeared?
                             print(f"WARNING: In search of merger for Ant {self.tracks[i].track_id}, no trace for Ant  {self.tracks[j].track_id}")
                         else:
@@ -309,10 +386,10 @@ class Tracker:
                                     # if needed, you might want to append self.tracks[j]'s merge_list items as well (if they exist)
                                     # basically tracks[i] will inherit the merged values of tracks[j]
                                     self.tracks[i].merge_list.append(self.tracks[j].track_id)  
-                                    self.tracks[i].merge_time.append(track_one_clip.current_timestamp)
+                                    self.tracks[i].merge_time.append(self.current_timestamp)
 
                                     if self.tracks[i].first_merge_time == -1 or self.tracks[i].attached_to_me == 0:
-                                        self.tracks[i].first_merge_time = track_one_clip.current_timestamp
+                                        self.tracks[i].first_merge_time = self.current_timestamp
 
                                     self.tracks[i].attached_to_me += 1  # increment attached_to_me, as we confirmed there was a merger
 
@@ -326,7 +403,7 @@ class Tracker:
                 try:
                     change_location = tuple(int(value[0]) for value in self.tracks[i].trace[-1])  # return last place seen (x, y)
                     for j in range(len(self.tracks)):
-                        if fps > track_one_clip.frame_counter - self.tracks[j].frame_first_seen > fps // 4:   # another ant just recently appeared
+                        if fps > self.frame_counter - self.tracks[j].frame_first_seen > fps // 4:   # another ant just recently appeared
                             lost_location = tuple(int(value[0]) for value in self.tracks[j].trace[-1])
 
                             # find distance between these two ants
@@ -339,7 +416,7 @@ class Tracker:
                             if distance < self.merge_distance * 2 and self.tracks[i].attached_to_me > 0:  # change me
                                 if self.tracks[j].track_id not in self.tracks[i].unmerge_list and self.tracks[i].track_id != self.tracks[j].track_id:
                                     self.tracks[i].unmerge_list.append(self.tracks[j].track_id)
-                                    self.tracks[i].unmerge_time.append(track_one_clip.current_timestamp)
+                                    self.tracks[i].unmerge_time.append(self.current_timestamp)
 
                                     # in theory, unmergers should only happen AFTER a merger
                                     # but its possible a recently unmerged clump of ants unmergers once again
@@ -353,9 +430,8 @@ class Tracker:
                                         # only prints a warning
 
                                     if self.tracks[i].attached_to_me == 0:  # ant is now considered "not merged"
-                                        self.tracks[i].last_unmerge_time = track_one_clip.current_timestamp
+                                        self.tracks[i].last_unmerge_time = self.current_timestamp
 
-                                        track_one_clip.merge_times.append((self.tracks[i].first_merge_time, self.tracks[i].last_unmerge_time))
                                         self.tracks[i].first_merge_time = -1
                                         self.tracks[i].last_unmerge_time = -1
                                     
@@ -364,7 +440,3 @@ class Tracker:
                 except Exception as e:
                     # print("ERROR UNMERGE", e)
                     pass
-                    
-        # copy to history
-        temp_id = self.tracks[i].track_id
-        Tracker.copy_track_to_history(self.histories[temp_id], self.tracks[i])
\ No newline at end of file
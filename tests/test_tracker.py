@@ -0,0 +1,65 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'scripts'))
+
+from tracker import Tracker
+
+DIST_THRESH = 10.0
+
+
+def random_frame(rng):
+    """Returns the (tracks, detections) positions of a random frame, in
+    which the gating can't change the assignment: the ants are in clusters
+    far apart from each other, every track and detection of a cluster is
+    within the distance threshold of the others in it, and there are only
+    extra tracks (ants which vanished) or only extra detections (ants which
+    appeared), never both.
+    """
+    clusters = rng.choice(400, size=rng.integers(1, 30), replace=False)
+    centers = np.stack([clusters % 20, clusters // 20], axis=1) * 100.0
+    tracks, detections = [], []
+    extra_tracks = rng.random() < 0.5
+    for center in centers:
+        size = rng.integers(1, 4)
+        extra = rng.integers(0, 2)
+        # the cost is half the distance, so points within 9 of the center cost at most 9
+        points = lambda n: center + rng.uniform(-6, 6, (n, 2))
+        tracks.append(points(size + (extra if extra_tracks else 0)))
+        detections.append(points(size + (0 if extra_tracks else extra)))
+    return np.concatenate(tracks), np.concatenate(detections)
+
+
+def cost_matrix(tracks, detections):
+    diff = tracks[:, np.newaxis, :] - detections[np.newaxis, :, :]
+    return 0.5 * np.sqrt((diff**2).sum(axis=2))
+
+
+def test_gated_assignment_matches_full_assignment():
+    rng = np.random.default_rng(0)
+    for _ in range(2000):
+        tracks, detections = random_frame(rng)
+        cost = cost_matrix(rng.permutation(tracks), rng.permutation(detections))
+        full_assignment, full_paired = Tracker.assign_full(cost, DIST_THRESH)
+        gated_assignment, gated_paired = Tracker.assign_gated(cost, DIST_THRESH)
+        assert gated_assignment == full_assignment
+        assert sorted(gated_paired) == sorted(full_paired)
+
+
+def test_gated_assignment_pairs_as_many_tracks_as_full_assignment():
+    # anywhere, including crowds where the assignments can differ, the same number of
+    # tracks counts as seen, and no pair is further apart than the threshold
+    rng = np.random.default_rng(1)
+    for _ in range(2000):
+        tracks = rng.uniform(0, 100, (rng.integers(0, 20), 2))
+        detections = rng.uniform(0, 100, (rng.integers(0, 20), 2))
+        cost = cost_matrix(tracks, detections).reshape(len(tracks), len(detections))
+        full_assignment, full_paired = Tracker.assign_full(cost, DIST_THRESH)
+        gated_assignment, gated_paired = Tracker.assign_gated(cost, DIST_THRESH)
+        assert len(set(gated_paired)) == len(gated_paired) == len(full_paired)
+        assert all(cost[i, j] <= DIST_THRESH for i, j in enumerate(gated_assignment) if j != -1)
+        assigned = [j for j in gated_assignment if j != -1]
+        assert len(set(assigned)) == len(assigned)
+        assert len(assigned) >= len([j for j in full_assignment if j != -1])